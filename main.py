@@ -1,9 +1,14 @@
 #!/usr/bin/env python3
-sock_pool = {}
-http_cache = {}
+sock_pool = None
+fetch_executor = None
+ssl_context = None
+tls_sessions = {}
+http_cache = None
 font_cache = {}
+font_backend = "tk"
 http_cache_dir = None
-http_cache_blob_dir = None
+http_cache_memory_budget = 32 * 1024 * 1024
+http_cache_disk_budget = 256 * 1024 * 1024
 default_rtl = False
 default_style_sheet = None
 default_search_engine = "https://lite.duckduckgo.com/lite?q="
@@ -101,9 +106,9 @@ class URL:
     def request(self, referrer=None, max_redirect=3, readcache=True, payload=None, cookies=None, method=None):
         if self.scheme == "about":
             if self.path == "blank":
-                return "", self
+                return {}, "", self
             else:
-                return "page not found", self
+                return {}, "page not found", self
         if self.scheme == "data":
             return {}, self.content, self
         elif self.scheme == "file":
@@ -111,87 +116,47 @@ class URL:
                 raise Exception("cannot POST payload to file")
             return self.request_file()
         else:
-            return self.request_socket(max_redirect, readcache, payload, cookies, referrer, method)
+            headers, chunks, url = self.request_socket(max_redirect, readcache, payload, cookies, referrer, method)
+            return headers, "".join(chunks), url
+
+    def request_stream(self, referrer=None, max_redirect=3, readcache=True, payload=None, cookies=None, method=None):
+        # same as request but the body is yielded as decoded text while it arrives
+        if self.scheme in ["about", "data", "file"]:
+            headers, content, url = self.request(referrer, max_redirect, readcache, payload, cookies, method)
+            return headers, ResponseBody([content]), url
+        return self.request_socket(max_redirect, readcache, payload, cookies, referrer, method)
 
     def request_file(self):
         with open(self.path) as f:
             return {}, f.read(), self
 
     def request_socket(self, max_redirect=3, readcache=True, payload=None, cookies=None, referrer=None, method=None):
-        global sock_pool
-        global http_cache
-        global http_cache_blob_dir
-
         if not method:
             method = "GET" if not payload else "POST"
 
-        if http_cache_dir:
-            import os
-            import json
-
-            http_cache_blob_dir = http_cache_dir + "/cache"
-
-            if not os.path.isdir(http_cache_blob_dir):
-                os.makedirs(http_cache_blob_dir)
-
-            cache_index = http_cache_dir + "/__cache.json"
-            if os.path.isfile(cache_index):
-                try:
-                    with open(cache_index, "r", encoding="utf8") as f:
-                        http_cache = json.load(f)
-                except Exception as err:
-                    print("Warning: Failed to load cache index", err)
-                    http_cache = {}
-
+        cache = get_http_cache()
         cache_key = self.get_cache_key() if method == "GET" else None
-        if cache_key and cache_key in http_cache and readcache:
-            cache_entry = http_cache[cache_key]
-            expires = cache_entry["expires"]
-            expired = False
-            if expires > 0:
+        cache_entry = None  # stale entry being revalidated
+        if cache_key and readcache:
+            cache_entry = cache.get(cache_key)
+            if cache_entry:
                 import time
 
-                if time.time() >= expires:
-                    expired = True
-            if expired:
-                del http_cache[cache_key]
-                if http_cache_blob_dir and "blob_id" in cache_entry:
-                    import os
-
-                    blob_id = cache_entry["blob_id"]
-                    os.remove(http_cache_blob_dir + "/" + blob_id)
-            else:
-                if "content" in cache_entry:
-                    content = cache_entry["content"]
-                    print("CACHED GET", cache_key)
-                    return content, self
-                if http_cache_blob_dir and "blob_id" in cache_entry:
-                    blob_id = cache_entry["blob_id"]
-                    with open(http_cache_blob_dir + "/" + blob_id, "rb") as f:
-                        bytes = f.read()
-                        content = bytes.decode("utf8")
+                expires = cache_entry["expires"]
+                stale = cache_entry.get("revalidate", False)
+                if expires > 0 and time.time() >= expires:
+                    stale = True
+                if not stale:
+                    content = cache.read_content(cache_entry)
+                    if content is not None:
                         print("CACHED GET", cache_key)
-                        return {}, content, self
-
-        key = (self.scheme, self.host, self.port)
-        s = None
-        f = None
-        if key in sock_pool:
-            (s, f) = sock_pool[key]  # reuse existing socket
-        else:
-            import socket  # init new TCP/IP connection
-            s = socket.socket(
-                family=socket.AF_INET,
-                type=socket.SOCK_STREAM,
-                proto=socket.IPPROTO_TCP,
-            )
-            s.connect((self.host, self.port))
-            if self.scheme == "https":
-                import ssl  # need encryption
-
-                ctx = ssl.create_default_context()
-                s = ctx.wrap_socket(s, server_hostname=self.host)
-            f = s.makefile("rb", encoding="utf8", newline="\r\n")
+                        return {}, ResponseBody([content]), self
+                    # blob went missing, drop entry and fetch again
+                    cache.remove(cache_key)
+                    cache_entry = None
+                elif "etag" not in cache_entry and "last_modified" not in cache_entry:
+                    cache.remove(cache_key)
+                    cache_entry = None
 
         reqlines = [
             f"{method} {self.path}{self.search} HTTP/1.1\r\n",
@@ -219,6 +184,11 @@ class URL:
         if referrer:
             referrer_str = referrer.get_str(with_fragment=False)
             reqlines.append("Referer: {}\r\n".format(referrer_str))
+        if cache_entry:
+            if "etag" in cache_entry:
+                reqlines.append("If-None-Match: {}\r\n".format(cache_entry["etag"]))
+            if "last_modified" in cache_entry:
+                reqlines.append("If-Modified-Since: {}\r\n".format(cache_entry["last_modified"]))
         if payload:
             length = len(payload.encode("utf8"))
             reqlines.append("Content-Length: {}\r\n".format(length))
@@ -227,13 +197,105 @@ class URL:
             reqlines.append(payload)
         request = "".join(reqlines)
         bytestosend = request.encode("utf8")
-        bytessent = s.send(bytestosend)
-        assert bytessent == len(bytestosend)
-        response = f
 
-        statusline = response.readline().decode("utf8")
+        pool = get_connection_pool()
+        key = (self.scheme, self.host, self.port)
+        retried = False
+        while True:
+            conn, reused = pool.acquire(key, self.connect)
+            s, response = conn
+            try:
+                s.sendall(bytestosend)
+                statusline = response.readline().decode("utf8")
+                if not statusline:
+                    raise ConnectionResetError("connection closed before response")
+                break
+            except BaseException as err:
+                pool.release(key, conn, keep_alive=False)
+                # server may have closed an idle keep-alive connection, that
+                # gets one more try, the pool could hand out stale ones forever
+                if not isinstance(err, OSError) or not reused or retried or method not in IDEMPOTENT_METHODS:
+                    raise
+                retried = True
+                print("Retrying", method, self.get_str(), "on new connection:", err)
+
+        try:
+            code, response_headers, keep_alive = self.read_response_head(statusline, response, method)
+        except Exception:
+            pool.release(key, conn, keep_alive=False)
+            raise
+        body = self.read_response_body(code, response_headers, conn, keep_alive)
+        try:
+            if "set-cookie" in response_headers and cookies:
+                cookie = response_headers["set-cookie"]
+                cookies.set_cookie_by_host(self.host, cookie)
+
+            if code == 304 and cache_entry:
+                drain(body)
+                content = cache.read_content(cache_entry)
+                if content is None:
+                    cache.remove(cache_key)
+                    return self.request_socket(max_redirect, False, payload, cookies, referrer, method)
+                # 304 may omit validators, the stored ones still apply
+                headers = {}
+                if "etag" in cache_entry:
+                    headers["etag"] = cache_entry["etag"]
+                if "last_modified" in cache_entry:
+                    headers["last-modified"] = cache_entry["last_modified"]
+                headers.update(response_headers)
+                policy = parse_cache_policy(headers)
+                if policy:
+                    policy["charset"] = cache_entry.get("charset", "utf-8")
+                    # the stored entry is shared with compaction, replace it instead
+                    cache.update(cache_key, dict(cache_entry, **policy))
+                else:
+                    cache.remove(cache_key)
+                print("REVALIDATED GET", cache_key)
+                return response_headers, ResponseBody([content]), self
+
+            if 300 <= code < 400 and max_redirect > 0:
+                location = response_headers.get("location")
+                if location:
+                    drain(body)
+                    url = URL(location, parent=self)
+                    return url.request_stream(max_redirect=max_redirect - 1, cookies=cookies, referrer=self)
+
+            charset = parse_charset(response_headers.get("content-type", ""))
+            chunks = body
+            if code == 200 and cache_key:
+                policy = parse_cache_policy(response_headers)
+                if policy:
+                    policy["charset"] = charset
+                    chunks = cache.write_stream(cache_key, policy, body)
+                elif cache_entry:
+                    cache.remove(cache_key)
+
+            return response_headers, body.wrap(decode_chunks(chunks, charset)), self
+        except BaseException:
+            # the body was not handed out, nobody else will release the connection
+            body.close()
+            raise
+
+    def connect(self):
+        import socket  # init new TCP/IP connection
+
+        s = socket.socket(
+            family=socket.AF_INET,
+            type=socket.SOCK_STREAM,
+            proto=socket.IPPROTO_TCP,
+        )
+        s.connect((self.host, self.port))
+        if self.scheme == "https":
+            # offer the last session for this origin for an abbreviated handshake
+            session = tls_sessions.get((self.host, self.port))
+            s = get_ssl_context().wrap_socket(s, server_hostname=self.host, session=session)
+        f = s.makefile("rb", encoding="utf8", newline="\r\n")
+        return s, f
+
+    def read_response_head(self, statusline, response, method):
         version, status, explanation = statusline.split(" ", 2)
         print(status, explanation.strip(), method, self.get_str())
+        code = int(status)
         response_headers = {}
         while True:
             line = response.readline().decode("utf8")
@@ -242,119 +304,52 @@ class URL:
             header, value = line.split(":", 1)
             response_headers[header.casefold()] = value.strip()
 
-        chunked = False
-        gzip = False
         if "content-encoding" in response_headers:
             content_encoding = response_headers["content-encoding"]
             assert content_encoding == "gzip"  # others not supported
-            gzip = True
 
         if "transfer-encoding" in response_headers:
             transfer_encoding = response_headers["transfer-encoding"]
-            if "chunked" in response_headers["transfer-encoding"]:
-                chunked = True
-            if "gzip" in transfer_encoding:
-                gzip = True
             assert "compress" not in transfer_encoding  # not supported
             assert "deflate" not in transfer_encoding  # not supported
 
-        if "set-cookie" in response_headers and cookies:
-            cookie = response_headers["set-cookie"]
-            cookies.set_cookie_by_host(self.host, cookie)
-
         keep_alive = response_headers.get("connection") == "keep-alive"
+        if has_response_body(code) and "content-length" not in response_headers:
+            if "chunked" not in response_headers.get("transfer-encoding", ""):
+                # HTTP/1.0 fallback length unknown -> body ends with the socket
+                keep_alive = False
         # print(response_headers)
-
-        if chunked:
-            chunks = []
-            is_transfer = True
-            while is_transfer:
-                chunk_size_str = response.readline().decode("utf8")
-                chunk_size = int(chunk_size_str, 16)
-                chunk = response.read(chunk_size)
-                assert len(chunk) == chunk_size
-                response.readline()  # finish reading line
-                chunks.append(chunk)
-                if chunk_size == 0:
-                    is_transfer = False
-            bytes = b"".join(chunks)
-            content_length = len(bytes)
-        elif "content-length" in response_headers:
-            content_length_str = response_headers["content-length"]
-            content_length = int(content_length_str)
-            bytes = response.read(content_length)
-            assert len(bytes) == content_length
-        else:
-            # HTTP/1.0 fallback length unknown -> read until end of socket
-            keep_alive = False
-            bytes = response.read()
-            s.close()
-
-        if gzip:
-            import gzip
-
-            bytes = gzip.decompress(bytes)
-            content_length = len(bytes)
-
-        content = bytes.decode("utf8")
-        code = int(status)
-
-        if keep_alive:
-            sock_pool[key] = (s, f)
-        elif key in sock_pool:
-            del sock_pool[key]
-
-        if 300 <= code < 400 and max_redirect > 0:
-            location = response_headers.get("location")
-            if location:
-                url = URL(location, parent=self)
-                return url.request(max_redirect=max_redirect - 1, cookies=cookies, referrer=self)
-
-        if code == 200 and method == "GET":
-            cache_control = response_headers.get("cache-control")
-            expires = 0
-            store = True
-            if cache_control is None:
-                pass
-            elif "no-store" in cache_control:
-                store = False
-            elif "max-age" in cache_control:
-                try:
-                    import time
-
-                    now = time.time()
-                    _, n = cache_control.split("=", 1)
-                    seconds = int(n.strip())
-                    expires = now + seconds * 1000
-                except Exception as err:
-                    import traceback
-
-                    print("Failed to handle cache control", err)
-                    print(traceback.format_exc())
-                    store = False
-            else:
-                # cache control not handled, better not cache
-                store = False
-
-            if store and cache_key:
-                cache_entry = {
-                    "expires": expires,
-                }
-                http_cache[cache_key] = cache_entry
-                if http_cache_blob_dir:
-                    import uuid
-
-                    blob_id = str(uuid.uuid4())
-                    blob_path = http_cache_blob_dir + "/" + blob_id
-                    cache_entry["blob_id"] = blob_id
-                    with open(blob_path, "wb") as f:
-                        f.write(bytes)
-                    with open(cache_index, "w", encoding="utf8") as f:
-                        json.dump(http_cache, f, indent=1)
-                else:
-                    cache_entry["content"] = content
-        
-        return response_headers, content, self
+        return code, response_headers, keep_alive
+
+    def read_response_body(self, code, response_headers, conn, keep_alive):
+        import zlib
+
+        s, response = conn
+        decompressor = None
+        transfer_encoding = response_headers.get("transfer-encoding", "")
+        if response_headers.get("content-encoding") == "gzip" or "gzip" in transfer_encoding:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)  # expect gzip header
+
+        def chunks():
+            for chunk in read_framed_body(code, response_headers, response):
+                if decompressor:
+                    chunk = decompressor.decompress(chunk)
+                if chunk:
+                    yield chunk
+            if decompressor:
+                chunk = decompressor.flush()
+                if chunk:
+                    yield chunk
+
+        def release(drained):
+            if self.scheme == "https" and s.session:
+                # TLS 1.3 tickets arrive after the handshake, so only now
+                # the session is resumable
+                tls_sessions[(self.host, self.port)] = s.session
+            # a connection abandoned mid body cannot be reused
+            get_connection_pool().release((self.scheme, self.host, self.port), conn, keep_alive and drained)
+
+        return ResponseBody(chunks(), release)
 
     def get_cache_key(self) -> str:
         return f"{self.scheme}://{self.host}:{self.port}{self.path}{self.search}"
@@ -379,12 +374,657 @@ class URL:
         return self.get_str()
 
 
+def has_response_body(code):
+    return not (code == 304 or code == 204 or 100 <= code < 200)
+
+
+class ResponseBody:
+    # body chunks with an explicit close, a body that is dropped unread
+    # still gives its connection back when closed
+    def __init__(self, chunks, on_close=None):
+        self.chunks = chunks
+        self.on_close = on_close
+        self.drained = False
+        self.closed = False
+
+    def __iter__(self):
+        try:
+            yield from self.chunks
+            self.drained = True
+        finally:
+            self.close()
+
+    def wrap(self, chunks):
+        # chunks derived from this body, closing them closes this too
+        return ResponseBody(chunks, lambda drained: self.close())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+        if self.on_close:
+            self.on_close(self.drained)
+
+
+def read_framed_body(code, response_headers, response, size=64 * 1024):
+    # yields raw body bytes as they arrive, framing removed
+    if not has_response_body(code):
+        return
+    if "chunked" in response_headers.get("transfer-encoding", ""):
+        while True:
+            chunk_size_str = response.readline().decode("utf8")
+            chunk_size = int(chunk_size_str.split(";")[0], 16)
+            if chunk_size == 0:
+                response.readline()  # finish reading line
+                return
+            yield from read_exactly(response, chunk_size, size)
+            response.readline()  # finish reading line
+    elif "content-length" in response_headers:
+        content_length = int(response_headers["content-length"])
+        yield from read_exactly(response, content_length, size)
+    else:
+        while True:
+            chunk = response.read1(size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def read_exactly(response, length, size):
+    while length > 0:
+        chunk = response.read1(min(length, size))
+        if not chunk:
+            raise ConnectionResetError("connection closed before end of body")
+        length -= len(chunk)
+        yield chunk
+
+
+def decode_chunks(chunks, charset="utf-8"):
+    import codecs
+
+    # incremental decoder keeps characters split between chunks
+    decoder = codecs.getincrementaldecoder(charset)(errors="replace")
+    for chunk in chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def drain(chunks):
+    for _ in chunks:
+        pass
+
+
+class HttpCache:
+    # compact once the journal outgrows the index by this many records
+    JOURNAL_SLACK = 256
+
+    def __init__(self, cache_dir, memory_budget=None, disk_budget=None):
+        import threading
+
+        # resources are fetched from several threads while a page loads
+        self.lock = threading.RLock()
+        # entries are kept in least recently used first order
+        self.entries = {}
+        # blobs are named by content hash and shared between entries,
+        # blob_refs maps blob id to [reference count, size]
+        self.blob_refs = {}
+        self.blobs = {}  # blob id to bytes when not stored on disk
+        self.size = 0
+        self.loaded = False
+        self.journal = None
+        self.journal_records = 0
+        self.compacting = False
+        self.compaction = None  # future of the background compaction
+        self.cache_dir = cache_dir
+        if cache_dir:
+            self.blob_dir = cache_dir + "/cache"
+            self.index_path = cache_dir + "/__cache.json"
+            self.journal_path = cache_dir + "/__cache.journal"
+            # journal taken over by a compaction that has not finished yet
+            self.old_journal_path = cache_dir + "/__cache.journal.old"
+            self.budget = disk_budget or http_cache_disk_budget
+        else:
+            self.blob_dir = None
+            self.index_path = None
+            self.journal_path = None
+            self.old_journal_path = None
+            self.budget = memory_budget or http_cache_memory_budget
+
+    def get(self, key):
+        import time
+
+        with self.lock:
+            self.load()
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            # access time is persisted with the next compaction, not journaled
+            entry["access"] = time.time()
+            self.entries[key] = entry
+            return entry
+
+    def put(self, key, entry, bytes):
+        writer = HttpCacheWriter(self)
+        writer.write(bytes)
+        writer.commit(key, entry)
+
+    def write_stream(self, key, entry, chunks):
+        # passes the body through, the entry is added once it is complete
+        writer = HttpCacheWriter(self)
+        try:
+            for chunk in chunks:
+                writer.write(chunk)
+                yield chunk
+            writer.commit(key, entry)
+        finally:
+            writer.discard()
+
+    def update(self, key, entry):
+        with self.lock:
+            self.load()
+            if key in self.entries:
+                self.entries[key] = entry
+                self._append_journal({"key": key, "entry": entry})
+
+    def remove(self, key):
+        with self.lock:
+            self.load()
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return
+            self._append_journal({"key": key, "remove": True})
+            self._release_blob(entry)
+
+    def read_content(self, entry):
+        with self.lock:
+            if "blob_id" not in entry:
+                return None
+            charset = entry.get("charset", "utf-8")
+            if not self.blob_dir:
+                bytes = self.blobs.get(entry["blob_id"])
+                return bytes.decode(charset, "replace") if bytes is not None else None
+            try:
+                with open(self.blob_dir + "/" + entry["blob_id"], "rb") as f:
+                    return f.read().decode(charset, "replace")
+            except FileNotFoundError:
+                return None
+
+    def clear(self):
+        with self.lock:
+            for key in list(self.entries.keys()):
+                self.remove(key)
+
+    def load(self):
+        with self.lock:
+            if self.loaded:
+                return
+            self.loaded = True
+            if not self.cache_dir:
+                return
+
+            import os
+            import json
+            import atexit
+
+            os.makedirs(self.blob_dir, exist_ok=True)
+            if os.path.isfile(self.index_path):
+                try:
+                    with open(self.index_path, "r", encoding="utf8") as f:
+                        self.entries = json.load(f)
+                except Exception as err:
+                    print("Warning: Failed to load cache index", err)
+                    self.entries = {}
+
+            # replay records appended since last compaction, a torn last line
+            # from a crash mid-write is dropped
+            torn = False
+            for path in [self.old_journal_path, self.journal_path]:
+                if not os.path.isfile(path):
+                    continue
+                with open(path, "r", encoding="utf8") as f:
+                    for line in f:
+                        try:
+                            record = json.loads(line)
+                        except ValueError:
+                            torn = True
+                            break
+                        self._apply(record)
+                        self.journal_records += 1
+            ordered = sorted(self.entries.items(), key=lambda x: x[1].get("access", 0))
+            self.entries = dict(ordered)
+            for entry in self.entries.values():
+                if "size" not in entry and "blob_id" in entry:
+                    # index written before sizes were tracked
+                    try:
+                        entry["size"] = os.path.getsize(self.blob_dir + "/" + entry["blob_id"])
+                    except OSError:
+                        entry["size"] = 0
+            for entry in self.entries.values():
+                self._retain_blob(entry)
+            self._sweep_orphan_blobs()
+            if torn:
+                # new records must not be appended after the torn line
+                self.compact()
+
+            atexit.register(self.close)
+            self._evict(self.budget)
+
+    def compact(self):
+        import os
+        import json
+
+        with self.lock:
+            if not self.cache_dir or not self.loaded or self.compacting:
+                return
+            self.compacting = True
+
+        try:
+            with self.lock:
+                # the snapshot is taken under the lock, new records go to a fresh
+                # journal while it is written out
+                snapshot = json.dumps(self.entries)
+                if self.journal:
+                    self.journal.close()
+                    self.journal = None
+                if os.path.isfile(self.journal_path):
+                    if os.path.isfile(self.old_journal_path):
+                        # previous compaction did not finish, keep its records too
+                        with open(self.old_journal_path, "a", encoding="utf8") as old:
+                            with open(self.journal_path, "r", encoding="utf8") as f:
+                                old.write(f.read())
+                        os.remove(self.journal_path)
+                    else:
+                        os.replace(self.journal_path, self.old_journal_path)
+                self.journal_records = 0
+
+            # snapshot goes to a temp file and replaces the index atomically,
+            # replaying a stale journal on top of it after a crash is harmless
+            tmp_path = self.index_path + ".tmp"
+            with open(tmp_path, "w", encoding="utf8") as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.index_path)
+            if os.path.isfile(self.old_journal_path):
+                os.remove(self.old_journal_path)
+        finally:
+            with self.lock:
+                self.compacting = False
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        except Exception as err:
+            print("Warning: Failed to compact cache index", err)
+
+    def close(self):
+        import atexit
+
+        with self.lock:
+            atexit.unregister(self.close)
+            if self.journal_records > 0:
+                self.compact()
+            if self.journal:
+                self.journal.close()
+                self.journal = None
+
+    def _evict(self, budget):
+        while self.size > budget and self.entries:
+            oldest_key = next(iter(self.entries))
+            self.remove(oldest_key)
+
+    def _sweep_orphan_blobs(self):
+        import os
+
+        for name in os.listdir(self.blob_dir):
+            if name not in self.blob_refs:
+                try:
+                    os.remove(self.blob_dir + "/" + name)
+                except OSError as err:
+                    print("Warning: Failed to remove orphaned cache blob", name, err)
+
+    def _apply(self, record):
+        key = record.get("key")
+        if record.get("remove"):
+            self.entries.pop(key, None)
+        elif "entry" in record:
+            self.entries[key] = record["entry"]
+
+    def _append_journal(self, record):
+        if not self.cache_dir:
+            return
+
+        import json
+
+        if not self.journal:
+            self.journal = open(self.journal_path, "a", encoding="utf8")
+        self.journal.write(json.dumps(record) + "\n")
+        self.journal.flush()
+        self.journal_records += 1
+        if self.journal_records > len(self.entries) + HttpCache.JOURNAL_SLACK:
+            # rewriting the index is too slow for the fetch path
+            if self.compaction is None or self.compaction.done():
+                self.compaction = get_fetch_executor().submit(self._compact_in_background)
+
+    def _retain_blob(self, entry):
+        blob_id = entry.get("blob_id")
+        if not blob_id:
+            return
+        if blob_id in self.blob_refs:
+            self.blob_refs[blob_id][0] += 1
+        else:
+            size = entry.get("size", 0)
+            self.blob_refs[blob_id] = [1, size]
+            self.size += size
+
+    def _release_blob(self, entry):
+        blob_id = entry.get("blob_id")
+        if not blob_id or blob_id not in self.blob_refs:
+            return
+        refs = self.blob_refs[blob_id]
+        refs[0] -= 1
+        if refs[0] > 0:
+            return
+        del self.blob_refs[blob_id]
+        self.size -= refs[1]
+        if not self.blob_dir:
+            self.blobs.pop(blob_id, None)
+            return
+
+        import os
+
+        try:
+            os.remove(self.blob_dir + "/" + blob_id)
+        except FileNotFoundError:
+            pass
+
+
+class HttpCacheWriter:
+    # hashes a body while it is written to a temporary blob, the blob is
+    # named by its hash only on commit
+    def __init__(self, cache):
+        import hashlib
+
+        cache.load()
+        self.cache = cache
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.chunks = []
+        self.file = None
+        self.tmp_path = None
+        self.done = False
+        if cache.blob_dir:
+            import os
+            import tempfile
+
+            fd, self.tmp_path = tempfile.mkstemp(suffix=".tmp", dir=cache.blob_dir)
+            self.file = os.fdopen(fd, "wb")
+
+    def write(self, bytes):
+        if self.done:
+            return
+        self.size += len(bytes)
+        if self.size > self.cache.budget:
+            # body can never fit, stop storing it
+            self.discard()
+            return
+        self.hash.update(bytes)
+        if self.file:
+            self.file.write(bytes)
+        else:
+            self.chunks.append(bytes)
+
+    def commit(self, key, entry):
+        import os
+        import time
+
+        cache = self.cache
+        if self.done:
+            cache.remove(key)
+            return
+        if self.file:
+            self.file.close()
+            self.file = None
+        blob_id = self.hash.hexdigest()
+        with cache.lock:
+            if cache.entries.get(key):
+                cache.remove(key)
+            if blob_id in cache.blob_refs:
+                self.discard()
+            elif self.tmp_path:
+                # blob must be on disk before the journal references it
+                os.replace(self.tmp_path, cache.blob_dir + "/" + blob_id)
+                self.tmp_path = None
+            else:
+                cache.blobs[blob_id] = b"".join(self.chunks)
+            self.done = True
+            self.chunks = []
+            entry["blob_id"] = blob_id
+            entry["size"] = self.size
+            entry["access"] = time.time()
+            cache.entries[key] = entry
+            cache._retain_blob(entry)
+            cache._append_journal({"key": key, "entry": entry})
+            cache._evict(cache.budget)
+
+    def discard(self):
+        import os
+
+        self.done = True
+        self.chunks = []
+        if self.file:
+            self.file.close()
+            self.file = None
+        if self.tmp_path:
+            try:
+                os.remove(self.tmp_path)
+            except FileNotFoundError:
+                pass
+            self.tmp_path = None
+
+
+def get_http_cache():
+    global http_cache
+
+    if http_cache is None or http_cache.cache_dir != http_cache_dir:
+        if http_cache:
+            http_cache.close()
+        http_cache = HttpCache(http_cache_dir)
+
+    return http_cache
+
+
+IDEMPOTENT_METHODS = ["GET", "HEAD", "PUT", "DELETE", "OPTIONS", "TRACE"]
+
+
+class ConnectionPool:
+    def __init__(self, max_per_host=6, max_total=32, idle_timeout=60, acquire_timeout=30):
+        import threading
+
+        self.max_per_host = max_per_host
+        self.max_total = max_total
+        self.idle_timeout = idle_timeout
+        # a leaked connection must not hang the browser forever
+        self.acquire_timeout = acquire_timeout
+        self.idle = {}  # key to list of (conn, last used), most recent last
+        self.in_use = {}  # key to number of connections handed out
+        self.open_count = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, key, connect):
+        import time
+
+        deadline = time.time() + self.acquire_timeout
+        with self.cond:
+            while True:
+                now = time.time()
+                self._expire_idle(now)
+                idle = self.idle.get(key)
+                while idle:
+                    conn, _ = idle.pop()
+                    if is_connection_alive(conn[0]):
+                        self.in_use[key] = self.in_use.get(key, 0) + 1
+                        return conn, True
+                    self._close(conn)
+                if self.in_use.get(key, 0) < self.max_per_host:
+                    if self.open_count >= self.max_total:
+                        self._close_oldest_idle()
+                    if self.open_count < self.max_total:
+                        # reserve the slot, connect outside of the lock
+                        self.in_use[key] = self.in_use.get(key, 0) + 1
+                        self.open_count += 1
+                        break
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError("no free connection to {} in {}s".format(key, self.acquire_timeout))
+                self.cond.wait(remaining)
+
+        try:
+            conn = connect()
+        except BaseException:
+            with self.cond:
+                self.in_use[key] -= 1
+                self.open_count -= 1
+                self.cond.notify_all()
+            raise
+        return conn, False
+
+    def release(self, key, conn, keep_alive):
+        import time
+
+        with self.cond:
+            self.in_use[key] -= 1
+            if keep_alive:
+                self.idle.setdefault(key, []).append((conn, time.time()))
+            else:
+                self._close(conn)
+            self.cond.notify_all()
+
+    def close_all(self):
+        with self.cond:
+            for idle in self.idle.values():
+                for conn, _ in idle:
+                    self._close(conn)
+            self.idle = {}
+
+    def _expire_idle(self, now):
+        for key, idle in self.idle.items():
+            while idle and now - idle[0][1] > self.idle_timeout:
+                conn, _ = idle.pop(0)
+                self._close(conn)
+
+    def _close_oldest_idle(self):
+        oldest = None
+        for key, idle in self.idle.items():
+            if idle and (oldest is None or idle[0][1] < self.idle[oldest][0][1]):
+                oldest = key
+        if oldest is not None:
+            conn, _ = self.idle[oldest].pop(0)
+            self._close(conn)
+
+    def _close(self, conn):
+        s, f = conn
+        self.open_count -= 1
+        try:
+            f.close()
+            s.close()
+        except OSError:
+            pass
+
+
+def is_connection_alive(s):
+    import select
+    import ssl
+
+    try:
+        readable, _, _ = select.select([s], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    if not readable:
+        return True
+    # an idle connection only becomes readable on close or when the TLS
+    # layer received records such as session tickets
+    try:
+        s.setblocking(False)
+        s.recv(1)
+        return False  # closed, or data nobody asked for
+    except (ssl.SSLWantReadError, BlockingIOError):
+        return True
+    except OSError:
+        return False
+    finally:
+        try:
+            s.setblocking(True)
+        except OSError:
+            pass
+
+
+def get_ssl_context():
+    global ssl_context
+
+    if ssl_context is None:
+        import ssl  # need encryption
+
+        # loading the CA bundle is expensive, and session tickets are only
+        # accepted by the context that received them
+        ssl_context = ssl.create_default_context()
+
+    return ssl_context
+
+
+def get_connection_pool():
+    global sock_pool
+
+    if sock_pool is None:
+        import atexit
+
+        sock_pool = ConnectionPool()
+        atexit.register(sock_pool.close_all)
+
+    return sock_pool
+
+
+def get_fetch_executor():
+    global fetch_executor
+
+    if fetch_executor is None:
+        import concurrent.futures
+
+        # as many workers as connections allowed to a single host
+        workers = get_connection_pool().max_per_host
+        fetch_executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="fetch")
+
+    return fetch_executor
+
+
+# placeholder style of nodes that were not styled yet, style() assigns
+# each node its own dict before writing to it
+EMPTY_STYLE = {}
+
+# most elements never get children, they share this tuple until the first
+# child is added, see Element.child_list
+EMPTY_CHILDREN = ()
+
+
 class Text:
+    __slots__ = ["text", "parent", "style", "style_dirty", "font", "__weakref__"]
+
+    # text nodes never have children, all of them share this empty tuple
+    children = EMPTY_CHILDREN
+    children_dirty = False
+
     def __init__(self, text, parent):
         self.text = text
-        self.children = []
         self.parent = parent
-        self.style = {}
+        self.style = EMPTY_STYLE
+        self.style_dirty = True
+        self.font = None
 
     def get_text(self):
         return self.text
@@ -394,12 +1034,19 @@ class Text:
 
 
 class Element:
+    # _visited, _href and ischecked stay unset until first evaluated
+    __slots__ = ["tag", "attributes", "children", "parent", "style", "style_dirty", "children_dirty", "font", "is_focused", "cursor", "ischecked", "_visited", "_href", "__weakref__"]
+
     def __init__(self, tag, attributes, parent):
         self.tag = tag
         self.attributes = attributes
-        self.children = []
+        self.children = EMPTY_CHILDREN
         self.parent = parent
-        self.style = {}
+        self.style = EMPTY_STYLE
+        # new nodes are unstyled, see mark_style_dirty
+        self.style_dirty = True
+        self.children_dirty = False
+        self.font = None
         self.is_focused = False
         self.cursor = 0
 
@@ -434,25 +1081,43 @@ class Element:
             if node.tag == tag:
                 return node
 
+    def child_list(self):
+        if self.children is EMPTY_CHILDREN:
+            self.children = []
+        return self.children
+
     def append_child(self, child):
         if child.parent:
             child.remove()
-        self.children.append(child)
+        self.child_list().append(child)
         child.parent = self
+        mark_style_dirty(self)
     
     def insert_before(self, child):
         for index, sibling in enumerate(self.parent.children):
             if sibling == self:
                 self.parent.children.insert(index, child)
                 child.parent = self.parent
+                mark_style_dirty(self.parent)
                 return
         
     def remove(self):
         if self.parent:
             self.parent.children.remove(self)
+            mark_style_dirty(self.parent)
             self.parent = None
 
 
+def mark_style_dirty(node):
+    # the subtree of node is styled again on the next render, ancestors
+    # get children_dirty so the restyle can find it from the root
+    node.style_dirty = True
+    node = node.parent
+    while node and not node.children_dirty:
+        node.children_dirty = True
+        node = node.parent
+
+
 def tree_to_list(tree, list):
     list.append(tree)
     for child in tree.children:
@@ -590,11 +1255,20 @@ class JSContext:
 
     def __init__(self, tab):
         import dukpy
+        import weakref
 
         self.interp = None
         self.tab = tab
-        self.node_to_handle = {}
-        self.handle_to_node = {}
+        # nodes are held weakly, only handles that js has wrappers for are pinned
+        self.node_to_handle = weakref.WeakKeyDictionary()
+        self.handle_to_ref = {}
+        self.pinned = {}
+        # times each handle was given to js, every time makes one wrapper
+        self.wrapped = {}
+        self.dead_handles = []
+        self.next_handle = 0
+        # event type -> handles with listeners, lets dispatch skip the interpreter
+        self.listeners = {}
         self.interp = dukpy.JSInterpreter()
         self._register_functions()
         self._load_runtime()
@@ -606,11 +1280,30 @@ class JSContext:
             return self.interp.evaljs(code)
         except dukpy.JSRuntimeError as e:
             print("Script", path, "crashed:\n", e)
+        finally:
+            self.flush()
+
+    def flush(self):
+        # apply whatever mutations the script left queued on the js side
+        # and let it forget listeners of nodes that were collected
+        import dukpy
+
+        dead = self.dead_handles
+        self.dead_handles = []
+        for handles in self.listeners.values():
+            handles.difference_update(dead)
+        try:
+            self.interp.evaljs("__flush(dukpy.dead)", dead=dead)
+        except dukpy.JSRuntimeError as e:
+            print("Script mutations failed:\n", e)
 
     def dispatch_event(self, type, elt):
         handle = self.node_to_handle.get(elt, -1)
         if handle < 0:
             return
+        if not self._has_listener(type, elt):
+            return False
+        self._pin(handle, elt)
         code = "__dispatch_event(dukpy.handle, dukpy.type)"
         do_default = self.interp.evaljs(code, type=type, handle=handle)
         return not do_default
@@ -621,7 +1314,9 @@ class JSContext:
         self.interp.evaljs(code, name=name, handle=handle)
 
     def remove_global_name(self, name, elt):
-        handle = self._get_handle(elt)
+        handle = self.node_to_handle.get(elt)
+        if handle is None:
+            return
         code = "__global_node_remove(dukpy.name, dukpy.handle)"
         self.interp.evaljs(code, name=name, handle=handle)
 
@@ -642,11 +1337,8 @@ class JSContext:
         js.export_function("document_set_title", self.tab.set_title)
         js.export_function("document_get_title", self.tab.get_title)
         js.export_function("document_get_body", self._document_get_body)
-        js.export_function("createElement", self._create_element)
-        js.export_function("createTextNode", self._create_text_node)
-        js.export_function("appendChild", self._append_child)
-        js.export_function("insertBefore", self._insert_before)
-        js.export_function("removeChild", self._remove_child)
+        js.export_function("batch", self._batch)
+        js.export_function("reserve_handles", self._reserve_handles)
         js.export_function("parent_get", self._node_parent_get)
         js.export_function("getComputedStyle", self._getComputedStyle)
         js.export_function("XHR_send", self._xhr_send)
@@ -655,12 +1347,59 @@ class JSContext:
         js.export_function("document_get_cookie", self._document_get_cookie)
         js.export_function("document_set_cookie", self._document_set_cookie)
 
+    def _batch(self, commands):
+        # commands come flattened as name followed by 3 argument slots
+        functions = {
+            "setAttribute": (self._setAttribute, 3),
+            "createElement": (self._create_element, 2),
+            "createTextNode": (self._create_text_node, 2),
+            "appendChild": (self._append_child, 2),
+            "insertBefore": (self._insert_before, 3),
+            "removeChild": (self._remove_child, 2),
+            "addEventListener": (self._add_event_listener, 2),
+            "release": (self._release, 2),
+        }
+        for i in range(0, len(commands), 4):
+            # each command is applied on its own, one that fails (like a
+            # stale handle) must not drop the ones queued after it
+            try:
+                function, count = functions[commands[i]]
+                function(*commands[i + 1:i + 1 + count])
+            except Exception as e:
+                print("Script mutation", i // 4, commands[i], "failed:", type(e).__name__, e)
+
+    def _release(self, handle, wrapped):
+        # js dropped its last wrapper, the node lives on only if the page has it.
+        # a release queued before the handle was given out again is stale
+        if wrapped == self.wrapped.get(handle):
+            self.pinned.pop(handle, None)
+
+    def _add_event_listener(self, handle, type):
+        self.listeners.setdefault(type, set()).add(handle)
+
+    def _has_listener(self, type, elt):
+        # events dispatched from python bubble, so ancestors count too
+        handles = self.listeners.get(type)
+        if not handles:
+            return False
+        node = elt
+        while node:
+            if self.node_to_handle.get(node) in handles:
+                return True
+            node = node.parent
+        return False
+
+    def _reserve_handles(self, count):
+        first = self.next_handle
+        self.next_handle += count
+        return first
+
     def _outerHTML_get(self, handle):
-        elt = self.handle_to_node[handle]
+        elt = self._node(handle)
         return format_tree_HTML(elt)
 
     def _innerHTML_get(self, handle):
-        elt = self.handle_to_node[handle]
+        elt = self._node(handle)
         return format_tree_HTML(elt.children)
 
     def _innerHTML_set(self, handle, html):
@@ -670,7 +1409,7 @@ class JSContext:
             if isinstance(node, Element) and node.attributes.get("id"):
                 self.add_global_name(node.attributes.get("id"), node)
         new_nodes = body.children
-        elt = self.handle_to_node[handle]
+        elt = self._node(handle)
         for node in tree_to_list(elt, []):
             if node == elt: 
                 continue
@@ -679,7 +1418,8 @@ class JSContext:
         elt.children = new_nodes
         for child in elt.children:
             child.parent = elt
-        self.tab.render()
+        mark_style_dirty(elt)
+        self.tab.schedule_render()
 
     def _querySelectorAll(self, selector):
         nodes = query_selector_all(selector, self.tab.nodes)
@@ -687,58 +1427,62 @@ class JSContext:
         return handles
 
     def _getAttribute(self, handle, attr):
-        elt = self.handle_to_node[handle]
+        elt = self._node(handle)
         attr = elt.attributes.get(attr, None)
         return attr if attr else ""
     
     def _setAttribute(self, handle, attr, value):
-        elt = self.handle_to_node[handle]
+        elt = self._node(handle)
         elt.attributes[attr] = value
+        mark_style_dirty(elt)
+        self.tab.schedule_render()
 
     def _children_get(self, handle):
-        parent = self.handle_to_node[handle]
+        parent = self._node(handle)
         return [self._get_handle(node) for node in parent.children if isinstance(node, Element)]
 
     def _document_get_body(self):
         return self._get_handle(self.tab.get_body())
 
-    def _create_element(self, tag):
-        element = Element(tag, {}, None)
-        return self._get_handle(element)
+    def _create_element(self, handle, tag):
+        self._set_handle(handle, Element(tag, {}, None))
 
-    def _create_text_node(self, text):
-        node = Text(text, None)
-        return self._get_handle(node)
+    def _create_text_node(self, handle, text):
+        self._set_handle(handle, Text(text, None))
 
     def _append_child(self, hparent, hchild):
-        parent = self.handle_to_node[hparent]
-        child = self.handle_to_node[hchild]
+        parent = self._node(hparent)
+        child = self._node(hchild)
         if isinstance(child, Element):
             self.tab.load_node(child)
         parent.append_child(child)
+        self.tab.schedule_render()
 
     def _insert_before(self, hparent, htoinsert, hreference):
-        target = self.handle_to_node[hreference]
-        toinsert = self.handle_to_node[htoinsert]
+        target = self._node(hreference)
+        toinsert = self._node(htoinsert)
         if isinstance(toinsert, Element):
             self.tab.load_node(toinsert)
         target.insert_before(toinsert)
+        self.tab.schedule_render()
     
     def _remove_child(self, hparent, hchild):
-        child = self.handle_to_node[hchild]
+        child = self._node(hchild)
         child.remove()
         if isinstance(child, Element):
             self.tab.unload_node(child)
+        self.tab.schedule_render()
 
     def _node_parent_get(self, handle):
         if handle < 0: 
             return handle
-        node = self.handle_to_node[handle]
+        node = self._node(handle)
         return self._get_handle(node.parent)
 
     def _getComputedStyle(self, handle):
-        self.tab.render()
-        node = self.handle_to_node[handle]
+        # styles have to be current, layout and paint can wait for the frame
+        self.tab.update_style()
+        node = self._node(handle)
         return node.style
 
     def _xhr_send(self, method, url, body):
@@ -779,7 +1523,7 @@ class JSContext:
         self.tab.restorestate()
 
     def _do_default(self, handle, event_type):
-        node = self.handle_to_node[handle]
+        node = self._node(handle)
         self.tab.do_default(node, event_type)
 
     def _document_get_cookie(self):
@@ -796,13 +1540,33 @@ class JSContext:
         if not elt:
             return -1
         if elt not in self.node_to_handle:
-            handle = len(self.node_to_handle)
-            self.node_to_handle[elt] = handle
-            self.handle_to_node[handle] = elt
+            handle = self._reserve_handles(1)
+            self._set_handle(handle, elt)
         else:
             handle = self.node_to_handle[elt]
+            self._pin(handle, elt)
         return handle
 
+    def _set_handle(self, handle, elt):
+        import weakref
+
+        self.node_to_handle[elt] = handle
+        self.handle_to_ref[handle] = weakref.KeyedRef(elt, self._collected, handle)
+        self._pin(handle, elt)
+
+    def _pin(self, handle, elt):
+        self.pinned[handle] = elt
+        self.wrapped[handle] = self.wrapped.get(handle, 0) + 1
+
+    def _node(self, handle):
+        return self.handle_to_ref[handle]()
+
+    def _collected(self, ref):
+        # the node is gone, js gets told at the next flush
+        del self.handle_to_ref[ref.key]
+        self.wrapped.pop(ref.key, None)
+        self.dead_handles.append(ref.key)
+
 
 def is_simple_request(method, headers=None):
     if method not in ["GET", "POST", "HEAD"]:
@@ -1284,6 +2048,79 @@ def format_http_date(t):
     return time.strftime(http_date_format, struct)
 
 
+def parse_charset(content_type):
+    import codecs
+
+    charset = "utf-8"
+    for param in content_type.split(";")[1:]:
+        name, _, value = param.partition("=")
+        if name.strip().casefold() == "charset":
+            charset = value.strip().strip('"')
+    try:
+        return codecs.lookup(charset).name
+    except LookupError:
+        print("Unsupported charset", charset, "falling back to utf-8")
+        return "utf-8"
+
+
+def parse_cache_policy(headers, now=None):
+    import time
+
+    if now is None:
+        now = time.time()
+
+    cache_control = headers.get("cache-control")
+    directives = {}
+    if cache_control:
+        for item in cache_control.split(","):
+            if "=" in item:
+                name, value = item.split("=", 1)
+                directives[name.strip().casefold()] = value.strip().strip('"')
+            elif item.strip():
+                directives[item.strip().casefold()] = ""
+    if "no-store" in directives:
+        return None
+
+    policy = {"expires": 0}
+    if "etag" in headers:
+        policy["etag"] = headers["etag"]
+    if "last-modified" in headers:
+        policy["last_modified"] = headers["last-modified"]
+    has_validators = "etag" in policy or "last_modified" in policy
+
+    lifetime = None
+    if "max-age" in directives:
+        try:
+            lifetime = int(directives["max-age"])
+        except ValueError:
+            lifetime = 0
+    elif "expires" in headers:
+        try:
+            lifetime = parse_http_date(headers["expires"]) - now
+        except ValueError:
+            lifetime = 0  # invalid dates such as "0" mean already expired
+
+    # stale entries are never served without revalidation, which also
+    # satisfies must-revalidate
+    if "no-cache" in directives:
+        policy["revalidate"] = True
+    elif lifetime is not None:
+        if lifetime > 0:
+            policy["expires"] = now + lifetime
+        else:
+            policy["revalidate"] = True
+    elif has_validators:
+        # no explicit freshness, ask the server on every use
+        policy["revalidate"] = True
+    elif cache_control is not None:
+        # cache control not handled, better not cache
+        return None
+
+    if policy.get("revalidate") and not has_validators:
+        return None
+    return policy
+
+
 class BrowserHistory:
     def __init__(self, profile_dir):
         self.file = (
@@ -1411,14 +2248,52 @@ def generate_bookmarks_page(bookmarks: BrowserBookmarks) -> str:
 
 
 class CLI:
+    # output is "text", "layout" for the layout tree or "display-list"
+    def __init__(self, output="text"):
+        self.output = output
+        self.width = 800
+        self.height = 600
+        self.hstep = 12
+        self.vstep = 18
+
     def browse(self, urlstr, max_redirect=5):
         print("navigating to", urlstr)
         url = URL(urlstr)
         _, result, url = url.request(max_redirect=max_redirect)
         if url.viewsource:
             print(result)
-        else:
+        elif self.output == "text":
             print(HTMLParser(result).parse().get_text())
+        else:
+            document = self.layout(HTMLParser(result).parse(), url)
+            if self.output == "layout":
+                print_tree(document)
+            else:
+                display_list = []
+                paint_tree(document, display_list)
+                for cmd in display_list:
+                    print(cmd)
+
+    def layout(self, nodes, url):
+        rules = get_initial_styling_rules()
+        for node in tree_to_list(nodes, []):
+            if not isinstance(node, Element):
+                continue
+            if node.tag == "style":
+                rules.extend(CSSParser(node.get_text()).parse())
+            elif node.tag == "link" and node.attributes.get("rel") == "stylesheet" and "href" in node.attributes:
+                style_url = URL(node.attributes["href"], parent=url)
+                try:
+                    _, body, _ = style_url.request(referrer=url)
+                    rules.extend(CSSParser(body).parse())
+                except Exception as e:
+                    print("failed to load stylesheet", style_url, e)
+        style(nodes, sorted(rules, key=cascade_priority))
+        document = DocumentLayout(nodes)
+        document.set_size(self.width, self.height)
+        document.set_step(self.hstep, self.vstep)
+        document.layout()
+        return document
 
 
 class GUIBrowser:
@@ -1428,6 +2303,9 @@ class GUIBrowser:
         self.chrome = None
         self.active_tab = None
         self.focus = None
+        self.content_layer = CanvasLayer("content")
+        self.drawn_chrome = None
+        self.frame_pending = False
 
     def setup(self, data):
         self.data = data
@@ -1627,14 +2505,30 @@ class GUIBrowser:
         tab.resize(width, height)
 
     def draw(self):
+        # everything asked for until tk is idle is rendered and drawn in
+        # one frame
+        if self.frame_pending or not self.window:
+            return
+        self.frame_pending = True
+        self.window.after_idle(self.draw_frame)
+
+    def draw_frame(self):
         import tkinter
 
+        self.frame_pending = False
+        self.active_tab.render()
         # print(tkinter.font.families())
-        self.canvas.delete("all")
-        self.active_tab.draw(self.canvas)
-
-        for cmd in self.chrome.paint():
-            cmd.execute(0, self.canvas)
+        # canvas items stay between draws, the page is moved when scrolled
+        # and the chrome is only redrawn when it painted something new
+        self.active_tab.draw(self.canvas, self.content_layer)
+
+        chrome = self.chrome.paint()
+        if chrome is not self.drawn_chrome:
+            self.drawn_chrome = chrome
+            self.canvas.delete("chrome")
+            for cmd in chrome:
+                cmd.execute(0, self.canvas, tags="chrome")
+        self.canvas.tag_raise("chrome")
 
         self.canvas.pack(fill=tkinter.BOTH, expand=1)
         self.state.save()
@@ -2158,6 +3052,9 @@ class HTMLChrome:
 
 
 class GUIBrowserTab:
+    # seconds between attempts to paint a page that is still downloading
+    PARTIAL_PAINT_INTERVAL = 0.1
+
     def __init__(self, browser):
         self.window = None
         self.canvas = None
@@ -2173,12 +3070,21 @@ class GUIBrowserTab:
         self.loadedpayload = ""
         self.toload = ""
         self.topayload = ""
-        self.display_list = []
+        self.display_list = DisplayList()
         self.scroll_bottom = 0
         self.rules = []
         self.modal = None
         self.js = None
         self.url = None
+        self.preloads = {}
+        self.document = None
+        # rules and index used by the last restyle, see render
+        self.styled_rules = None
+        self.rule_index = None
+        self.needs_layout = False
+        self.needs_paint = False
+        # restyled subtrees waiting to be laid out again
+        self.relayout_nodes = []
 
     def browse(self, url):
         self.state.browse(url)
@@ -2209,6 +3115,7 @@ class GUIBrowserTab:
                 </form>
             """,
             )
+            self.needs_paint = True
             self.render()
             return
     
@@ -2246,9 +3153,9 @@ class GUIBrowserTab:
         headers = {}
         if url.scheme == "about":  # handle meta pages
             if url.path == "blank":
-                result = ""
+                chunks = ResponseBody([""])
             elif url.path == "bookmarks":
-                result = generate_bookmarks_page(self.browser.bookmarks)
+                chunks = ResponseBody([generate_bookmarks_page(self.browser.bookmarks)])
             else:
                 raise Exception("about page not found!")
         else:  # external data source
@@ -2256,7 +3163,7 @@ class GUIBrowserTab:
                 import time
 
                 self.browser.cookies.purge_expired_by_host(url.host, time.time())
-                headers, result, url = url.request(max_redirect=5, readcache=readcache, payload=payload, cookies=self.browser.cookies, referrer=referrer, method=method)
+                headers, chunks, url = url.request_stream(max_redirect=5, readcache=readcache, payload=payload, cookies=self.browser.cookies, referrer=referrer, method=method)
                 if self.url is not url:
                     self.url = url # url may change due to request handling redirect
                 self.state.set_secure("yes" if self.url.scheme == "https" else "")
@@ -2269,47 +3176,54 @@ class GUIBrowserTab:
                 result = generate_error_page(err, url)
                 raise err
 
-        self.allowed_origins = None
-        if "content-security-policy" in headers:
-            csp = headers["content-security-policy"].split()
-            if len(csp) > 0 and csp[0] == "default-src":
-                self.allowed_origins = []
-                for origin in csp[1:]:
-                    self.allowed_origins.append(URL(origin).origin())
-
-        self.referrer_policy = None
-        if "referrer-policy" in headers:
-            policy = headers["referrer-policy"]
-            if policy in ['no-referrer', 'same-origin']:
-                self.referrer_policy = policy
-            else:
-                self.referrer_policy = 'no-referrer'
-                print('Using no-referrer because referrer policy {} not supported', policy)
+        try:
+            self.allowed_origins = None
+            if "content-security-policy" in headers:
+                csp = headers["content-security-policy"].split()
+                if len(csp) > 0 and csp[0] == "default-src":
+                    self.allowed_origins = []
+                    for origin in csp[1:]:
+                        self.allowed_origins.append(URL(origin).origin())
+
+            self.referrer_policy = None
+            if "referrer-policy" in headers:
+                policy = headers["referrer-policy"]
+                if policy in ['no-referrer', 'same-origin']:
+                    self.referrer_policy = policy
+                else:
+                    self.referrer_policy = 'no-referrer'
+                    print('Using no-referrer because referrer policy {} not supported', policy)
 
-        parser_class = HTMLParser if not url.viewsource else HTMLSourceParser
+            parser_class = HTMLParser if not url.viewsource else HTMLSourceParser
 
-        self.nodes = parser_class(result).parse()
+            visited_urls = self.browser.history.get_visited_set()
+            self.nodes = self.parse_stream(parser_class(), chunks, visited_urls)
 
-        rules = get_initial_styling_rules()
-        self.rules = rules
+            rules = get_initial_styling_rules()
+            self.rules = rules
+
+            nodelist = tree_to_list(self.nodes, [])
+            self.preload(nodelist)
+            for node in nodelist:
+                if isinstance(node, Element):
+                    eval_visited(node, url, visited_urls)
+                    id = node.attributes.get("id")
+                    if id and self.js:
+                        self.js.add_global_name(id, node)
+                    self.load_node(node)
+                    # node may have triggered navigation, abort further action on this page
+                    if url is not self.url:
+                        return
+        finally:
+            # gives the connection back if the body was not read to the end
+            chunks.close()
+            self.cancel_preloads()
 
-        nodelist = tree_to_list(self.nodes, [])
-        visited_urls = self.browser.history.get_visited_set()
-        for node in nodelist:
-            if isinstance(node, Element):
-                eval_visited(node, url, visited_urls)
-                id = node.attributes.get("id")
-                if id and self.js:
-                    self.js.add_global_name(id, node)
-                self.load_node(node)
-                # node may have triggered navigation, abort further action on this page
-                if url is not self.url:
-                    return
-        
 
         # style(self.nodes, sorted(rules, key=cascade_priority))
         # print_tree(self.nodes)
 
+        mark_style_dirty(self.nodes)
         self.render()
         # print_tree(self.document)
 
@@ -2338,6 +3252,91 @@ class GUIBrowserTab:
         elif node.tag == "script" and self.is_js_enabled():
             self.load_script(node)
 
+    def parse_stream(self, parser, chunks, visited_urls):
+        import time
+
+        # paint the first screenful while the rest of the page downloads
+        next_paint = time.time() + GUIBrowserTab.PARTIAL_PAINT_INTERVAL
+        for chunk in chunks:
+            parser.feed(chunk)
+            if next_paint and time.time() >= next_paint:
+                if self.paint_partial(parser.tree(), visited_urls):
+                    next_paint = None
+                else:
+                    next_paint = time.time() + GUIBrowserTab.PARTIAL_PAINT_INTERVAL
+        return parser.close()
+
+    def paint_partial(self, tree, visited_urls):
+        if tree is None:
+            return False
+        nodelist = tree_to_list(tree, [])
+        self.preload(nodelist)
+        rules = self.partial_rules(nodelist)
+        if rules is None:
+            # hold the paint until stylesheets arrive, to avoid a flash of
+            # unstyled content
+            return False
+        for node in nodelist:
+            if isinstance(node, Element):
+                eval_visited(node, self.url, visited_urls)
+        self.nodes = tree
+        self.rules = rules
+        # the parser keeps adding to nodes that were already styled
+        mark_style_dirty(tree)
+        self.render()
+        self.browser.draw()
+        self.browser.canvas.update_idletasks()
+        return self.scroll_bottom >= self.height
+
+    def partial_rules(self, nodelist):
+        rules = get_initial_styling_rules()
+        for node in nodelist:
+            if not isinstance(node, Element):
+                continue
+            if node.tag == "style":
+                rules.extend(CSSParser(node.get_text()).parse())
+            elif node.tag == "link" and node.attributes.get("rel") == "stylesheet" and "href" in node.attributes:
+                future = self.preloads.get(URL(node.attributes["href"], parent=self.url).get_str())
+                if future is None or not future.done():
+                    return None
+                try:
+                    _, body, url = future.result()
+                    rules.extend(CSSParser(body).parse())
+                except Exception:
+                    pass  # reported when the stylesheet is loaded
+        return rules
+
+    def preload(self, nodelist):
+        # start fetching external stylesheets and scripts up front, they are
+        # still applied in document order as load_node reaches them
+        executor = get_fetch_executor()
+        for node in nodelist:
+            if not isinstance(node, Element):
+                continue
+            url = None
+            try:
+                if node.tag == "link" and node.attributes.get("rel") == "stylesheet" and "href" in node.attributes:
+                    url = URL(node.attributes["href"], parent=self.url)
+                elif node.tag == "script" and node.attributes.get("src") and self.is_js_enabled():
+                    url = URL(node.attributes["src"], parent=self.url)
+                    if not self.allowed_request(url):
+                        url = None
+            except Exception as e:
+                print("failed to preload", node.tag, e)
+            if url and url.get_str() not in self.preloads:
+                self.preloads[url.get_str()] = executor.submit(url.request, referrer=self.url)
+
+    def cancel_preloads(self):
+        for future in self.preloads.values():
+            future.cancel()
+        self.preloads = {}
+
+    def fetch(self, url):
+        future = self.preloads.get(url.get_str())
+        if future:
+            return future.result()
+        return url.request(referrer=self.url)
+
     def load_link(self, node):
         if (
             node.attributes.get("rel") == "stylesheet"
@@ -2346,7 +3345,7 @@ class GUIBrowserTab:
             link = node.attributes["href"]
             style_url = URL(link, parent=self.url)
             try:
-                _, body, url = style_url.request(referrer=self.url)
+                _, body, url = self.fetch(style_url)
                 self.rules.extend(CSSParser(body).parse())
             except Exception as e:
                 print("failed to load stylesheet", style_url, e)
@@ -2360,7 +3359,7 @@ class GUIBrowserTab:
                 if not self.allowed_request(script_url):
                     print("Blocked script", script_url, "due to CSP")
                     return
-                _, code, url = script_url.request(referrer=self.url)
+                _, code, url = self.fetch(script_url)
             else:
                 script_url = f'{self.url}'
                 code = node.get_text()
@@ -2387,29 +3386,63 @@ class GUIBrowserTab:
     def allowed_request(self, url):
         return self.allowed_origins is None or url.origin() in self.allowed_origins
 
-    def render(self):
-        self.display_list = []
-        if self.nodes:
-            style(self.nodes, sorted(self.rules, key=cascade_priority))
-            self.document = DocumentLayout(self.nodes)
-            self.document.set_size(self.width, self.height)
-            self.document.set_step(self.hstep, self.vstep)
-            self.document.layout()
-            self.scroll_bottom = self.document.height
-            paint_tree(self.document, self.display_list)
-        if self.modal:
-            rect = Rect(0, 0, self.width, self.height)
-            self.display_list.append(DrawRect(rect, "black", None, opacity=0.2))
+    def schedule_render(self):
+        # rendered and drawn with the next frame, changes made until then
+        # share one pass through the pipeline
+        self.browser.draw()
 
-    def draw(self, canvas):
-        for cmd in self.display_list:
-            if cmd.rect.top > self.scroll + self.height:
-                continue
-            if cmd.rect.bottom < self.scroll:
-                continue
-            cmd.execute(self.scroll - self.top, canvas)
+    def update_style(self):
+        if not self.nodes:
+            return
+        if self.rules != self.styled_rules:
+            # stylesheets changed, everything is styled again
+            self.styled_rules = list(self.rules)
+            self.rule_index = RuleIndex(sorted(self.rules, key=cascade_priority))
+            mark_style_dirty(self.nodes)
+        if self.nodes.style_dirty or self.nodes.children_dirty:
+            if any(self.rule_index.has_children_test):
+                # :has() may now match differently further up the tree
+                mark_style_dirty(self.nodes)
+            restyle(self.nodes, self.rule_index, AncestorFilter(), self.relayout_nodes)
 
-        # scrollbar
+    def render(self):
+        # only the stages something was invalidated for are redone, nodes
+        # are marked with mark_style_dirty, layout and paint on the tab
+        self.update_style()
+        if self.nodes:
+            relayout_nodes = self.relayout_nodes
+            self.relayout_nodes = []
+            if self.needs_layout or self.document is None or self.document.node is not self.nodes:
+                full = True
+            elif relayout_nodes:
+                # only blocks around the restyled subtrees, the rest moves
+                full = not self.document.relayout(relayout_nodes)
+            else:
+                full = False
+            if full:
+                self.document = DocumentLayout(self.nodes)
+                self.document.set_size(self.width, self.height)
+                self.document.set_step(self.hstep, self.vstep)
+                self.document.layout()
+            if full or relayout_nodes:
+                self.scroll_bottom = self.document.height
+                self.needs_layout = False
+                self.needs_paint = True
+        if self.needs_paint:
+            self.needs_paint = False
+            display_list = []
+            if self.nodes:
+                paint_tree(self.document, display_list)
+            if self.modal:
+                rect = Rect(0, 0, self.width, self.height)
+                display_list.append(DrawRect(rect, "black", None, opacity=0.2))
+            self.display_list = DisplayList(display_list)
+
+    def draw(self, canvas, layer):
+        layer.draw(canvas, self.display_list, self.scroll, self.top, self.height)
+
+        # scrollbar and dialog are few items, they are simply redrawn
+        canvas.delete("overlay")
         if self.scroll_bottom > self.height:
             pos_0 = self.scroll / self.scroll_bottom
             pos_1 = (self.scroll + self.height) / self.scroll_bottom
@@ -2419,11 +3452,12 @@ class GUIBrowserTab:
                 self.width,
                 self.top + self.height * pos_1,
                 fill="#000",
+                tags="overlay",
             )
 
         if self.modal:
             for cmd in self.modal.display_list:
-                cmd.execute(-self.modal.rect.top-self.top, canvas, hscroll=-self.modal.rect.left)
+                cmd.execute(-self.modal.rect.top-self.top, canvas, hscroll=-self.modal.rect.left, tags="overlay")
 
     def scrollposupdate(self, amount=100):
         self.scroll += amount
@@ -2452,6 +3486,7 @@ class GUIBrowserTab:
                     self.load(self.toload, readcache=False, payload=self.topayload)
                 if action == "closedialog":
                     self.modal = None
+                self.needs_paint = True
                 self.render()
             return
 
@@ -2462,13 +3497,11 @@ class GUIBrowserTab:
 
         y += self.scroll
 
-        for item in reversed(self.display_list):
-            if not item.rect.contains_point(x, y):
-                continue
-            if not hasattr(item, "node"):
-                continue
+        # hit testing needs the geometry of changes still waiting for a frame
+        self.render()
+        item = self.display_list.hit_test(x, y)
+        if item:
             node = item.node
-            break
         
         self.click_node(node, button)
 
@@ -2506,7 +3539,9 @@ class GUIBrowserTab:
             self.focus.is_focused = True
 
         if need_render:
-            self.render()
+            # checkbox state and cursor are only drawn, not laid out
+            self.needs_paint = True
+            self.schedule_render()
 
         if form_submit and form:
             self.submit_form(form)
@@ -2532,14 +3567,17 @@ class GUIBrowserTab:
         if self.focus:
             self.focus.is_focused = False
             self.focus = None
-            self.render()
+            self.needs_paint = True
+            self.schedule_render()
 
     def input(self, txt):
         if self.focus:
             if self.dispatch_js_event("keydown", self.focus):
                 return True
             if input_element_handle_input(self.focus, txt):
-                self.render()
+                # inputs have a fixed width, typing only needs a repaint
+                self.needs_paint = True
+                self.schedule_render()
                 return True
         return False
 
@@ -2549,7 +3587,8 @@ class GUIBrowserTab:
         if self.dispatch_js_event("keydown", self.focus):
             return True
         if input_element_move_cursor(self.focus, +1):
-            self.render()
+            self.needs_paint = True
+            self.schedule_render()
             return True
         return False
 
@@ -2559,7 +3598,8 @@ class GUIBrowserTab:
         if self.dispatch_js_event("keydown", self.focus):
             return True
         if input_element_move_cursor(self.focus, -1):
-            self.render()
+            self.needs_paint = True
+            self.schedule_render()
             return True
         return False
 
@@ -2568,7 +3608,8 @@ class GUIBrowserTab:
             if self.dispatch_js_event("keydown", self.focus):
                 pass
             elif input_element_handle_backspace(self.focus):
-                self.render()
+                self.needs_paint = True
+                self.schedule_render()
             return True
         return False
 
@@ -2584,6 +3625,7 @@ class GUIBrowserTab:
         self.width = width
         self.height = height
         if self.nodes:
+            self.needs_layout = True
             self.render()
             self.limitscrollinbounds()
 
@@ -2707,8 +3749,9 @@ class HTMLView:
         self.scroll_bottom = self.document.height
     
     def paint(self):
-        self.display_list = []
-        paint_tree(self.document, self.display_list)
+        display_list = []
+        paint_tree(self.document, display_list)
+        self.display_list = DisplayList(display_list)
 
     def focus_on_node(self, node):
         self.blur()
@@ -2754,13 +3797,8 @@ class HTMLView:
         if self.focus:
             self.focus.is_focused = False
             self.focus = None
-        for item in reversed(self.display_list):
-            if not item.rect.contains_point(x, y):
-                continue
-            if not hasattr(item, "node"):
-                continue
-            node = item.node
-            break
+        item = self.display_list.hit_test(x, y)
+        node = item.node if item else None
         need_render = False
         while node:
             # logic is somewhat duplicated from browser tab
@@ -2808,6 +3846,68 @@ class DocumentLayout:
         self.children.append(child)
         child.layout()
         self.height = child.height
+        # element to its block, to find what to lay out again on change
+        self.blocks = {}
+        self.register_blocks(child)
+
+    def register_blocks(self, layout_object):
+        if isinstance(layout_object, BlockLayout) and isinstance(layout_object.node, Element):
+            self.blocks[layout_object.node] = layout_object
+        for child in layout_object.children:
+            self.register_blocks(child)
+
+    def forget_blocks(self, layout_object):
+        if isinstance(layout_object, BlockLayout) and isinstance(layout_object.node, Element):
+            if self.blocks.get(layout_object.node) is layout_object:
+                del self.blocks[layout_object.node]
+        for child in layout_object.children:
+            self.forget_blocks(child)
+
+    def find_block(self, node):
+        while node and node not in self.blocks:
+            node = node.parent
+        return self.blocks.get(node)
+
+    def relayout(self, nodes):
+        # lays out again the blocks containing nodes, blocks after them
+        # move by the change in height, returns False when only a full
+        # layout can do it
+        blocks = []
+        for node in nodes:
+            block = self.find_block(node)
+            if block is None:
+                return False
+            blocks.append(block)
+        targets = []
+        for block in blocks:
+            parent = block.parent
+            while parent is not self:
+                if not isinstance(parent, BlockLayout):
+                    # blocks inside buttons are sized by their input
+                    return False
+                if parent in blocks:
+                    break
+                parent = parent.parent
+            else:
+                if block not in targets:
+                    targets.append(block)
+
+        for block in targets:
+            old_height = block.height
+            self.forget_blocks(block)
+            block.children = []
+            block.layout()
+            self.register_blocks(block)
+            dy = block.height - old_height
+            child = block
+            while dy and child is not self:
+                parent = child.parent
+                index = parent.children.index(child)
+                for sibling in parent.children[index + 1:]:
+                    shift_layout(sibling, dy)
+                parent.height += dy
+                child = parent
+        return True
 
     def set_size(self, w, h):
         self.width = w
@@ -2827,6 +3927,12 @@ class DocumentLayout:
         return f"Document {self.node} {self.x} {self.y} {self.width} {self.height}"
 
 
+def shift_layout(layout_object, dy):
+    layout_object.y += dy
+    for child in layout_object.children:
+        shift_layout(child, dy)
+
+
 class BlockLayout:
     def __init__(self, node, parent, previous):
         self.node = node
@@ -2954,7 +4060,7 @@ class BlockLayout:
                     if child.tag == "nav" and child.attributes.get("id") == "toc":
                         # insert table of contest title
                         element = Element("pre", {}, self.node)
-                        element.children.append(Text("Table of Contents", element))
+                        element.child_list().append(Text("Table of Contents", element))
                         next = BlockLayout(element, self, previous)
                         self.children.append(next)
                         previous = next
@@ -3042,52 +4148,11 @@ class BlockLayout:
         input = InputLayout(node, line, previous_word)
         line.children.append(input)
 
-        weight = node.style["font-weight"]
-        style = node.style["font-style"]
-        if style == "normal":
-            style = "roman"
-        size = int(parse_size(node.style["font-size"]) * 0.75)
-        font = get_font("", size, weight, style)
-
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += w + node_font(node).space_width
 
     def word(self, node: Text):
-        # TODO remove duplicate, this should be part of TextLayout
-
-        # parse font style
-        style = node.style.get("font-style", "normal")
-        if style == "inherit":
-            style = "roman"  # todo actually inherit
-        elif style == "oblique" or style == "italic":
-            style = "italic"  # tk inter only supports
-        else:
-            style = "roman"  # normal style and default to roman
-
-        # parse font size
-        size_str = node.style.get("font-size", "16px")
-        if size_str == "inherit":
-            size = int(16 * 0.75)
-        else:
-            try:
-                size = int(parse_size(size_str) * 0.75)
-            except Exception as e:
-                print("Failed to parse size", size_str, e)
-                size = int(16 * 0.75)
-
-        font_family = node.style.get("font-family")
-
-        # parse font weight
-        weight = "normal"
-        font_weight = node.style.get("font-weight", "normal")
-        if font_weight.isnumeric():
-            if int(font_weight) >= 500:
-                weight = "bold"
-        elif font_weight == "bold":
-            weight = "bold"
-
-        font = get_font(font_family, size, weight, style)
-        color = node.style.get("color", "black")
-        space_width = font.measure(" ")
+        font = node_font(node)
+        space_width = font.space_width
 
         # line = self.children[-1]
         # previous_word = line.children[-1] if line.children else None
@@ -3140,7 +4205,7 @@ class BlockLayout:
     def tryhypenate(self, font, txt, node):
         if "\N{SOFT HYPHEN}" in txt:
             isnewline = False
-            space_width = font.measure(" ")
+            space_width = font.space_width
             parts = txt.split("\N{SOFT HYPHEN}")
             while parts:
                 failed = True
@@ -3259,48 +4324,13 @@ class TextLayout:
 
     def layout(self):
         node = self.node
-
-        # parse font style
-        style = node.style.get("font-style", "normal")
-        if style == "inherit":
-            style = "roman"  # todo actually inherit
-        elif style == "oblique" or style == "italic":
-            style = "italic"  # tk inter only supports
-        else:
-            style = "roman"  # normal style and default to roman
-
-        # parse font size
-        size_str = node.style.get("font-size", "16px")
-        if size_str == "inherit":
-            size = int(16 * 0.75)
-        else:
-            try:
-                size = int(parse_size(size_str) * 0.75)
-            except Exception as e:
-                print("Failed to parse size", size_str, e)
-                size = int(16 * 0.75)
-
-        font_family = node.style.get("font-family")
-
-        # parse font weight
-        weight = "normal"
-        font_weight = node.style.get("font-weight", "normal")
-        if font_weight.isnumeric():
-            if int(font_weight) >= 500:
-                weight = "bold"
-        elif font_weight == "bold":
-            weight = "bold"
-
-        font = get_font(font_family, size, weight, style)
         self.color = node.style.get("color", "black")
-        space_width = font.measure(" ")
-
-        self.font = get_font(font_family, size, weight, style)
+        self.font = node_font(node)
 
         self.width = self.font.measure(self.word)
 
         if self.previous:
-            space = self.previous.font.measure(" ")
+            space = self.previous.font.space_width
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
@@ -3348,40 +4378,8 @@ class InputLayout:
 
     def layout(self):
         node = self.node
-
-        # parse font style
-        style = node.style.get("font-style", "normal")
-        if style == "inherit":
-            style = "roman"  # todo actually inherit
-        elif style == "oblique" or style == "italic":
-            style = "italic"  # tk inter only supports
-        else:
-            style = "roman"  # normal style and default to roman
-
-        # parse font size
-        size_str = node.style.get("font-size", "16px")
-        if size_str == "inherit":
-            size = int(16 * 0.75)
-        else:
-            try:
-                size = int(parse_size(size_str) * 0.75)
-            except Exception as e:
-                print("Failed to parse size", size_str, e)
-                size = int(16 * 0.75)
-
-        font_family = node.style.get("font-family")
-
-        # parse font weight
-        weight = "normal"
-        font_weight = node.style.get("font-weight", "normal")
-        if font_weight.isnumeric():
-            if int(font_weight) >= 500:
-                weight = "bold"
-        elif font_weight == "bold":
-            weight = "bold"
-
         self.color = node.style.get("color", "black")
-        self.font = get_font(font_family, size, weight, style)
+        self.font = node_font(node)
 
         self.width = InputLayout.determine_width(self.node)
 
@@ -3398,7 +4396,7 @@ class InputLayout:
         self.pbottom = pbottom
 
         if self.previous:
-            space = self.previous.font.measure(" ")
+            space = self.previous.font.space_width
             self.x = self.previous.x + space + self.previous.width
         else:
             self.x = self.parent.x
@@ -3550,6 +4548,101 @@ class InputLayout:
         return f"Input {self.x},{self.y} {self.width},{self.height}"
 
 
+class DisplayList:
+    # paint commands bucketed by the vertical bands they overlap, drawing
+    # and hit testing only look at the bands in range instead of every
+    # command on the page
+    BAND = 256
+
+    def __init__(self, cmds=()):
+        self.cmds = list(cmds)
+        self.bands = bands = {}
+        size = DisplayList.BAND
+        for index, cmd in enumerate(self.cmds):
+            rect = cmd.rect
+            first = int(rect.top // size)
+            last = int(rect.bottom // size)
+            if first == last:
+                # most commands are a word or a box within a single band
+                bands.setdefault(first, []).append(index)
+                continue
+            first, last = self.band_range(rect.top, rect.bottom)
+            for band in range(first, last + 1):
+                bands.setdefault(band, []).append(index)
+
+    def band_range(self, top, bottom):
+        if bottom < top:
+            top, bottom = bottom, top
+        return int(top // DisplayList.BAND), int(bottom // DisplayList.BAND)
+
+    def __iter__(self):
+        return iter(self.cmds)
+
+    def __len__(self):
+        return len(self.cmds)
+
+    def hit_test(self, x, y):
+        # topmost command under the point that belongs to a node
+        cmds = self.cmds
+        for index in reversed(self.bands.get(int(y // DisplayList.BAND), ())):
+            cmd = cmds[index]
+            if cmd.rect.contains_point(x, y) and hasattr(cmd, "node"):
+                return cmd
+        return None
+
+
+class CanvasLayer:
+    # canvas items for one display list, created the first time their band
+    # comes into view, after that scrolling only moves them. a repaint makes
+    # a new display list and the visible items are all recreated, commands
+    # are not diffed against the previous list
+    def __init__(self, tag):
+        self.tag = tag
+        self.display_list = None
+        self.offset = 0
+        self.bands = set()
+        # created command indices in paint order and their canvas items
+        self.indices = []
+        self.items = []
+
+    def draw(self, canvas, display_list, scroll, top, height):
+        import bisect
+
+        offset = top - scroll
+        if display_list is not self.display_list:
+            canvas.delete(self.tag)
+            self.display_list = display_list
+            self.offset = offset
+            self.bands = set()
+            self.indices = []
+            self.items = []
+        elif offset != self.offset:
+            canvas.move(self.tag, 0, offset - self.offset)
+            self.offset = offset
+
+        created = False
+        first, last = display_list.band_range(scroll, scroll + height)
+        for band in range(first, last + 1):
+            if band in self.bands:
+                continue
+            self.bands.add(band)
+            for index in display_list.bands.get(band, ()):
+                position = bisect.bisect_left(self.indices, index)
+                if position < len(self.indices) and self.indices[position] == index:
+                    continue  # created with an earlier band
+                cmd = display_list.cmds[index]
+                item = cmd.execute(-offset, canvas, tags=self.tag)
+                if position < len(self.items):
+                    # painted before items already on the canvas
+                    canvas.tag_lower(item, self.items[position])
+                self.indices.insert(position, index)
+                self.items.insert(position, item)
+                created = True
+        if created:
+            # page content stays under the chrome and overlays
+            canvas.tag_lower(self.tag)
+
+
 def paint_tree(layout_object, display_list):
     if layout_object.should_paint():
         display_list.extend(layout_object.paint())
@@ -3583,16 +4676,149 @@ def query_selector_all(selector, node):
 
 def get_font(family, size, weight, style):
     FONTS = font_cache
-    key = (family, size, weight, style)
-    if key not in FONTS:
+    key = (font_backend, family, size, weight, style)
+    if key not in FONTS and font_backend == "headless":
+        FONTS[key] = (CachedFont(HeadlessFont(family, size, weight, style)), None)
+    elif key not in FONTS:
         import tkinter.font
 
         font = tkinter.font.Font(family=family, size=size, weight=weight, slant=style)
         label = tkinter.Label(font=font)
-        FONTS[key] = (font, label)
+        FONTS[key] = (CachedFont(font), label)
     return FONTS[key][0]
 
 
+def node_font(node):
+    # resolved once per styled node, style_tree clears it again
+    font = node.font
+    if font is None:
+        font = node.font = get_font(*parse_font(node.style))
+    return font
+
+
+def parse_font(style):
+    # parse font style
+    font_style = style.get("font-style", "normal")
+    if font_style == "inherit":
+        slant = "roman"  # todo actually inherit
+    elif font_style == "oblique" or font_style == "italic":
+        slant = "italic"  # tk inter only supports
+    else:
+        slant = "roman"  # normal style and default to roman
+
+    # parse font size
+    size_str = style.get("font-size", "16px")
+    if size_str == "inherit":
+        size = int(16 * 0.75)
+    else:
+        try:
+            size = int(parse_size(size_str) * 0.75)
+        except Exception as e:
+            print("Failed to parse size", size_str, e)
+            size = int(16 * 0.75)
+
+    font_family = style.get("font-family")
+
+    # parse font weight
+    weight = "normal"
+    font_weight = style.get("font-weight", "normal")
+    if font_weight.isnumeric():
+        if int(font_weight) >= 500:
+            weight = "bold"
+    elif font_weight == "bold":
+        weight = "bold"
+
+    return font_family, size, weight, slant
+
+
+class HeadlessFont:
+    # font metrics without tk, glyph advances come from a fixed table so
+    # layout gives the same result on any machine and without a display
+    # advances for " " to "~" in thousandths of an em, close to helvetica
+    ADVANCES = [
+        278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+        556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556,
+        1015, 667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778,
+        667, 778, 722, 667, 611, 722, 667, 944, 667, 667, 611, 278, 278, 278, 469, 556,
+        333, 556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556,
+        556, 556, 333, 500, 278, 556, 500, 722, 500, 500, 500, 334, 260, 334, 584,
+    ]
+    DEFAULT_ADVANCE = 556
+    MONOSPACE_ADVANCE = 600
+    MONOSPACE_FAMILIES = ["monospace", "courier", "courier new", "consolas", "monaco"]
+
+    def __init__(self, family, size, weight, slant):
+        self.name = f"{family or 'default'} {size} {weight} {slant}"
+        # tk sizes are in points, 72 points per inch at 96 pixels per inch
+        self.pixels = size * 96 / 72
+        self.monospace = (family or "").casefold() in HeadlessFont.MONOSPACE_FAMILIES
+        # bold glyphs are about a tenth wider
+        self.scale = self.pixels / 1000 * (1.1 if weight == "bold" else 1.0)
+
+    def measure(self, text):
+        if self.monospace:
+            return round(len(text) * HeadlessFont.MONOSPACE_ADVANCE * self.scale)
+        advances = HeadlessFont.ADVANCES
+        total = 0
+        for char in text:
+            code = ord(char) - 32
+            if 0 <= code < len(advances):
+                total += advances[code]
+            else:
+                total += HeadlessFont.DEFAULT_ADVANCE
+        return round(total * self.scale)
+
+    def metrics(self):
+        ascent = round(self.pixels * 0.9)
+        descent = round(self.pixels * 0.25)
+        return {
+            "ascent": ascent,
+            "descent": descent,
+            "linespace": ascent + descent,
+            "fixed": 1 if self.monospace else 0,
+        }
+
+    def __str__(self):
+        return self.name
+
+
+class CachedFont:
+    # every measure or metrics call on a tkinter font is a round trip into
+    # Tcl, the same words get measured over and over so widths are kept
+    MAX_WIDTHS = 4096
+
+    def __init__(self, font):
+        import collections
+
+        self.font = font
+        self.widths = collections.OrderedDict()
+        self.metrics_dict = None
+        self.space_width = self.measure(" ")
+
+    def measure(self, text):
+        widths = self.widths
+        width = widths.get(text)
+        if width is None:
+            width = self.font.measure(text)
+            widths[text] = width
+            if len(widths) > CachedFont.MAX_WIDTHS:
+                widths.popitem(last=False)
+        else:
+            widths.move_to_end(text)
+        return width
+
+    def metrics(self, option=None):
+        if self.metrics_dict is None:
+            self.metrics_dict = self.font.metrics()
+        if option:
+            return self.metrics_dict[option]
+        return dict(self.metrics_dict)
+
+    def __str__(self):
+        # canvas items take the tkinter font name
+        return str(self.font)
+
+
 def get_initial_styling_rules():
     global default_style_sheet
 
@@ -3612,16 +4838,20 @@ class DrawText:
         self.color = color
         self.node = node
 
-    def execute(self, scroll, canvas, hscroll=0):
-        canvas.create_text(
+    def execute(self, scroll, canvas, hscroll=0, tags=()):
+        return canvas.create_text(
             self.rect.left - hscroll,
             self.rect.top - scroll,
             text=self.text,
             font=self.font,
             anchor="nw",
             fill=self.color,
+            tags=tags,
         )
 
+    def __repr__(self):
+        return f"DrawText {self.rect} {repr(self.text)} {self.font} {self.color}"
+
 
 class DrawRect:
     def __init__(self, rect, color, node, opacity=1.0):
@@ -3641,8 +4871,8 @@ class DrawRect:
             self.stipple = None
             self.fill = None
 
-    def execute(self, scroll, canvas, hscroll=0):
-        canvas.create_rectangle(
+    def execute(self, scroll, canvas, hscroll=0, tags=()):
+        return canvas.create_rectangle(
             self.rect.left - hscroll,
             self.rect.top - scroll,
             self.rect.right - hscroll,
@@ -3650,8 +4880,12 @@ class DrawRect:
             width=0,
             fill=self.fill,
             stipple=self.stipple,
+            tags=tags,
         )
 
+    def __repr__(self):
+        return f"DrawRect {self.rect} {self.color}"
+
 
 class DrawOutline:
     def __init__(self, rect, color, thickness, node):
@@ -3660,16 +4894,20 @@ class DrawOutline:
         self.thickness = thickness
         self.node = node
 
-    def execute(self, scroll, canvas, hscroll=0):
-        canvas.create_rectangle(
+    def execute(self, scroll, canvas, hscroll=0, tags=()):
+        return canvas.create_rectangle(
             self.rect.left - hscroll,
             self.rect.top - scroll,
             self.rect.right - hscroll,
             self.rect.bottom - scroll,
             width=self.thickness,
             outline=self.color,
+            tags=tags,
         )
 
+    def __repr__(self):
+        return f"DrawOutline {self.rect} {self.color} {self.thickness}"
+
 
 class DrawLine:
     def __init__(self, x1, y1, x2, y2, color, thickness):
@@ -3677,16 +4915,20 @@ class DrawLine:
         self.color = color
         self.thickness = thickness
 
-    def execute(self, scroll, canvas, hscroll=0):
-        canvas.create_line(
+    def execute(self, scroll, canvas, hscroll=0, tags=()):
+        return canvas.create_line(
             self.rect.left - hscroll,
             self.rect.top - scroll,
             self.rect.right - hscroll,
             self.rect.bottom - scroll,
             fill=self.color,
             width=self.thickness,
+            tags=tags,
         )
 
+    def __repr__(self):
+        return f"DrawLine {self.rect} {self.color} {self.thickness}"
+
 
 class Rect:
     def __init__(self, left, top, right, bottom):
@@ -3698,6 +4940,9 @@ class Rect:
     def contains_point(self, x, y):
         return x >= self.left and x < self.right and y >= self.top and y < self.bottom
 
+    def __repr__(self):
+        return f"{self.left},{self.top} {self.right},{self.bottom}"
+
     def create_dialog(self, width, height):
         left = (self.left + self.right - width) // 2
         top = (self.top + self.bottom - height) // 2
@@ -3740,7 +4985,7 @@ class HTMLParser:
         "&rsquo;":"’",
     }
 
-    SELF_CLOSING_TAGS = [
+    SELF_CLOSING_TAGS = {
         "area",
         "base",
         "br",
@@ -3755,9 +5000,9 @@ class HTMLParser:
         "source",
         "track",
         "wbr",
-    ]
+    }
 
-    HEAD_TAGS = [
+    HEAD_TAGS = {
         "base",
         "basefont",
         "bgsound",
@@ -3767,56 +5012,127 @@ class HTMLParser:
         "title",
         "style",
         "script",
-    ]
+    }
 
     FORMATTING_TAGS = [
         "b",
         "i",
     ]
 
-    def __init__(self, body):
+    IN_HEAD_TAGS = HEAD_TAGS | {"/head"}
+
+    HTML_CHILD_TAGS = {"head", "body", "/html"}
+
+    AUTO_CLOSING_TAGS = {"p", "li", "button"}
+
+    def __init__(self, body=""):
+        import re
+        import sys
+
         self.body = body
         self.unfinished = []
+        # looked up once here, add_text and get_attributes run for every token
+        self.intern = sys.intern
+        self.attribute_part = re.compile(r"""(?:[^\s"']|"[^"]*(?:"|\Z)|'[^']*(?:'|\Z))+""")
+        # tokenizer state survives between fed chunks
+        self.in_tag = False
+        self.in_quoted_value = False
+        self.quote_terminator = "'"
+        self.in_entity = False
+        self.entity = ""
+        self.in_special_tag = False
+        self.in_comment = False
+        self.in_script = False
+        self.text = ""
+        self.parsed_dash = 0
 
     def parse(self):
-        body = self.body
-        in_tag = False
-        in_quoted_value = False
-        quote_terminator = "'"
-        in_entity = False
-        in_special_tag = False
-        in_comment = False
-        in_script = False
-        text = ""
-        parsed_dash = 0
-        for c in body:
+        self.feed(self.body)
+        return self.close()
+
+    def tree(self):
+        # root of the partially parsed document, open elements are already
+        # attached to their parents
+        return self.unfinished[0] if self.unfinished else None
+
+    def feed(self, body):
+        import re
+
+        # text up to the next & or <, optionally followed by a whole tag
+        # without ! or & outside of quoted values, or by a whole comment
+        token = re.compile(
+            r"""([^&<]*)(?:<([^!"'&>]*(?:(?:"[^"]*"|'[^']*')[^!"'&>]*)*)>|<!--[^->][\s\S]*?-->)?"""
+        )
+        # characters that end a run of plain characters in other states
+        tag_stop = re.compile("""[!"'&>]""")
+        entity_stop = re.compile("[&;]")
+        entity_tag_stop = re.compile("""[!"'&;]""")
+        in_tag = self.in_tag
+        in_quoted_value = self.in_quoted_value
+        quote_terminator = self.quote_terminator
+        in_entity = self.in_entity
+        entity = self.entity
+        in_special_tag = self.in_special_tag
+        in_comment = self.in_comment
+        in_script = self.in_script
+        text = self.text
+        parsed_dash = self.parsed_dash
+        i = 0
+        n = len(body)
+        while i < n:
             if in_quoted_value:
-                if c == quote_terminator:
-                    in_quoted_value = False
-                text += c
+                j = body.find(quote_terminator, i)
+                if j < 0:
+                    text += body[i:]
+                    break
+                text += body[i:j + 1]
+                in_quoted_value = False
+                i = j + 1
             elif in_special_tag:
                 if in_script:
-                    text += c
-                    if text.endswith("</script>"):
-                        text = text[:-9]  # remove </script>
-                        self.add_text(text)
-                        text = ""
-                        in_special_tag = False
-                        in_script = False
-                        in_tag = False
-                        self.add_tag("/script")
+                    # the end tag may be split between chunks
+                    start = max(0, len(text) - 8)
+                    consumed = len(text)
+                    text += body[i:]
+                    j = text.find("</script>", start)
+                    if j < 0:
+                        break
+                    i += j + 9 - consumed
+                    text = text[:j]  # remove </script>
+                    self.add_text(text)
+                    text = ""
+                    in_special_tag = False
+                    in_script = False
+                    in_tag = False
+                    self.add_tag("/script")
                 elif in_comment:
-                    if c == "-":
-                        parsed_dash -= 1
-                        if parsed_dash < 0:
-                            parsed_dash = 0
-                    elif c == ">" and parsed_dash == 0:
-                        in_comment = False
-                        in_special_tag = False
-                        in_tag = False
-                    else:
-                        parsed_dash = 2  # reset
+                    # comment ends at the first > after at least two dashes
+                    while i < n and parsed_dash < 2:
+                        c = body[i]
+                        i += 1
+                        if c == "-":
+                            parsed_dash = max(parsed_dash - 1, 0)
+                        elif c == ">" and parsed_dash == 0:
+                            in_comment = False
+                            in_special_tag = False
+                            in_tag = False
+                            break
+                        else:
+                            parsed_dash = 2  # reset
+                    if not in_comment or i >= n:
+                        continue
+                    j = body.find("-->", i)
+                    if j < 0:
+                        rest = body[i:]
+                        parsed_dash = max(2 - (len(rest) - len(rest.rstrip("-"))), 0)
+                        break
+                    i = j + 3
+                    in_comment = False
+                    in_special_tag = False
+                    in_tag = False
                 else:
+                    c = body[i]
+                    i += 1
                     if c == "-":
                         parsed_dash += 1
                     elif c == ">":
@@ -3826,48 +5142,99 @@ class HTMLParser:
                         in_comment = True
                     else:
                         parsed_dash = 0
-            elif in_tag and c == "!":
-                in_special_tag = True
-                parsed_dash = 0
-                text = ""
-            elif in_tag and (c == '"' or c == "'"):
-                in_quoted_value = True
-                quote_terminator = c
-                text += c
-            elif c == "&":
-                in_entity = True
-                entity = "&"
-            elif in_entity:
-                entity += c
-                if c == ";":
+            elif not in_tag and not in_entity:
+                match = token.match(body, i)
+                run, tag = match.groups()
+                j = i + len(run)
+                i = match.end()
+                if run:
+                    text += run
+                if i > j:
+                    if text:
+                        self.add_text(text)
+                    text = ""
+                    if tag is not None:
+                        if tag == "script" or tag.startswith("script "):
+                            in_special_tag = True
+                            in_script = True
+                        self.add_tag(tag)
+                    continue
+                if i == n:
+                    break
+                i += 1
+                if body[j] == "&":
+                    in_entity = True
+                    entity = "&"
+                else:
+                    in_tag = True
+                    if text:
+                        self.add_text(text)
+                    text = ""
+            else:
+                if in_entity:
+                    stop = entity_tag_stop if in_tag else entity_stop
+                else:
+                    stop = tag_stop
+                match = stop.search(body, i)
+                j = match.start() if match else n
+                if in_entity:
+                    entity += body[i:j]
+                else:
+                    text += body[i:j]
+                if j == n:
+                    break
+                c = body[j]
+                i = j + 1
+                if c == "!":
+                    in_special_tag = True
+                    parsed_dash = 0
+                    text = ""
+                elif c == '"' or c == "'":
+                    in_quoted_value = True
+                    quote_terminator = c
+                    text += c
+                elif c == "&":
+                    in_entity = True
+                    entity = "&"
+                elif c == ";":
+                    entity += c
                     in_entity = False
                     entity = HTMLParser.ENTITY_MAP.get(entity, entity)
                     text += entity
-            elif c == "<" and not in_tag:
-                in_tag = True
-                if text:
-                    self.add_text(text)
-                text = ""
-            elif c == ">" and in_tag:
-                in_tag = False
-                if text == "script" or text.startswith("script "):
-                    in_special_tag = True
-                    in_script = True
-                self.add_tag(text)
-                text = ""
-            else:
-                text += c
-        if not in_tag and text:
-            self.add_text(text)
+                else:  # > closing the tag
+                    in_tag = False
+                    if text == "script" or text.startswith("script "):
+                        in_special_tag = True
+                        in_script = True
+                    self.add_tag(text)
+                    text = ""
+        self.in_tag = in_tag
+        self.in_quoted_value = in_quoted_value
+        self.quote_terminator = quote_terminator
+        self.in_entity = in_entity
+        self.entity = entity
+        self.in_special_tag = in_special_tag
+        self.in_comment = in_comment
+        self.in_script = in_script
+        self.text = text
+        self.parsed_dash = parsed_dash
+
+    def close(self):
+        if not self.in_tag and self.text:
+            self.add_text(self.text)
+        self.text = ""
         return self.finish()
 
     def add_text(self, text, force=False):
+        if text.isspace():
+            # indentation repeats all over a document, keep one copy of each
+            text = self.intern(text)
         self.implicit_tags(None)
         parent = self.unfinished[-1] if self.unfinished else None
         node = Text(text, parent)
 
         if self.unfinished:
-            parent.children.append(node)
+            parent.child_list().append(node)
         else:
             self.unfinished.append(node)
 
@@ -3876,22 +5243,18 @@ class HTMLParser:
         if tag.startswith("!"):
             return
         self.implicit_tags(tag)
+        unfinished = self.unfinished
         if tag.startswith("/"):
             # closing tags
             name = tag[1:]
             popped = None
-            while len(self.unfinished) > 1 and self.unfinished[-1].tag != name:
+            while len(unfinished) > 1 and unfinished[-1].tag != name:
                 if not popped:
                     popped = []
-                node = self.unfinished.pop()
-                parent = self.unfinished[-1]
-                parent.children.append(node)
-                popped.append(node)
-            if len(self.unfinished) == 1:
+                popped.append(unfinished.pop())
+            if len(unfinished) == 1:
                 return
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+            unfinished.pop()
             # reopen formatting tags
             if popped:
                 for node in popped:
@@ -3899,124 +5262,144 @@ class HTMLParser:
                         self.add_tag(node.tag)
         elif tag in self.SELF_CLOSING_TAGS:
             # self closing
-            parent = self.unfinished[-1]
+            parent = unfinished[-1]
             node = Element(tag, attributes, parent)
-            parent.children.append(node)
+            parent.child_list().append(node)
         else:
-            # open new tag
-            parent = self.unfinished[-1] if self.unfinished else None
+            # open new tag, attached right away so a partial tree can render
+            parent = unfinished[-1] if unfinished else None
             node = Element(tag, attributes, parent)
-            self.unfinished.append(node)
+            if parent:
+                parent.child_list().append(node)
+            unfinished.append(node)
 
     def finish(self):
         if not self.unfinished:
             self.implicit_tags(None)
-        while len(self.unfinished) > 1:
-            node = self.unfinished.pop()
-            parent = self.unfinished[-1]
-            parent.children.append(node)
+        del self.unfinished[1:]
         return self.unfinished.pop()
 
     def get_attributes(self, text):
-        part = ""
-        parts = []
-        in_quote = False
-        quote_char = ""
-        for c in text:
-            if in_quote:
-                if c == quote_char:
-                    in_quote = False
-                part += c
-            elif c.isspace():
-                if part:
-                    parts.append(part)
-                    part = ""
-            elif c == "'" or c == '"':
-                in_quote = True
-                quote_char = c
-                part += c
-            else:
-                part += c
-        if part:
-            parts.append(part)
+        if "'" in text or '"' in text:
+            # quoted runs may contain whitespace, an unterminated quote runs to the end
+            parts = self.attribute_part.findall(text)
+        else:
+            parts = text.split()
 
-        tag = parts[0].casefold()
+        # names are interned so every node shares the same strings
+        intern = self.intern
+        tag = intern(parts[0].casefold())
         attributes = {}
         for attrpair in parts[1:]:
             if "=" in attrpair:
-                key, value = attrpair.split("=", 1)
-                if len(value) > 2 and value[0] in ["'", '"']:
+                key, _, value = attrpair.partition("=")
+                if len(value) > 2 and value[0] in "'\"":
                     value = value[1:-1]
-                attributes[key.casefold()] = value
+                attributes[intern(key.casefold())] = value
             else:
-                attributes[attrpair.casefold()] = ""
+                attributes[intern(attrpair.casefold())] = ""
         return tag, attributes
 
     def implicit_tags(self, tag):
+        # insertion mode follows from the stack depth and the current node,
+        # so no token needs to look at the whole stack
+        unfinished = self.unfinished
         while True:
-            open_tags = [node.tag for node in self.unfinished]
-            if open_tags == [] and tag != "html":
+            depth = len(unfinished)
+            if depth == 0:
+                if tag == "html":
+                    break
                 self.add_tag("html")
-            elif open_tags == ["html"] and tag not in ["head", "body", "/html"]:
+                continue
+            current = unfinished[-1].tag
+            if depth == 1 and current == "html":
+                if tag in self.HTML_CHILD_TAGS:
+                    break
                 if tag in self.HEAD_TAGS:
                     self.add_tag("head")
                 else:
                     self.add_tag("body")
-            elif (
-                open_tags == ["html", "head"] and tag not in ["/head"] + self.HEAD_TAGS
-            ):
+            elif depth == 2 and current == "head" and unfinished[0].tag == "html":
+                if tag in self.IN_HEAD_TAGS:
+                    break
                 self.add_tag("/head")
-            elif open_tags and open_tags[-1] == tag and tag in ["p", "li", "button"]:
+            elif current == tag and tag in self.AUTO_CLOSING_TAGS:
                 self.add_tag("/" + tag)
-            elif open_tags and open_tags[-1] == "li" and tag in ["/ul", "/ol"]:
+            elif current == "li" and (tag == "/ul" or tag == "/ol"):
                 self.add_tag("/li")
             else:
                 break
 
 
 class HTMLSourceParser(HTMLParser):
-    def parse(self):
+    def __init__(self, body=""):
+        super().__init__(body)
         self.add_tag("pre")
-        text = ""
-        in_tag = False
-        in_quoted_value = False
-        in_special_tag = False
-        quote_type = "'"
-        for c in self.body:
-            if in_tag:
-                if c == "!" and text == "<":
-                    in_special_tag = True
-                    text += c
-                elif in_quoted_value:
-                    if c == quote_type:
-                        in_quoted_value = False
-                    text += c
-                elif c in ["'", '"']:
+
+    def feed(self, body):
+        import re
+
+        tag_stop = re.compile("""["'>]""")
+        text = self.text
+        in_tag = self.in_tag
+        in_quoted_value = self.in_quoted_value
+        in_special_tag = self.in_special_tag
+        quote_type = self.quote_terminator
+        i = 0
+        n = len(body)
+        while i < n:
+            if not in_tag:
+                j = body.find("<", i)
+                if j < 0:
+                    text += body[i:]
+                    break
+                text += body[i:j]
+                self.add_tag("b")
+                self.add_text(text, force=True)
+                self.add_tag("/b")
+                text = "<"
+                in_tag = True
+                i = j + 1
+            elif text == "<" and body[i] == "!":
+                in_special_tag = True
+                text += "!"
+                i += 1
+            elif in_quoted_value:
+                j = body.find(quote_type, i)
+                if j < 0:
+                    text += body[i:]
+                    break
+                text += body[i:j + 1]
+                in_quoted_value = False
+                i = j + 1
+            else:
+                match = tag_stop.search(body, i)
+                if not match:
+                    text += body[i:]
+                    break
+                j = match.start()
+                c = body[j]
+                text += body[i:j + 1]
+                i = j + 1
+                if c != ">":
                     in_quoted_value = True
                     quote_type = c
-                    text += c
-                elif c == ">":
-                    text += c
-                    if in_special_tag:
-                        self.add_tag("i")
-                    self.add_text(text, force=True)
-                    if in_special_tag:
-                        self.add_tag("/i")
-                    text = ""
-                    in_tag = False
-                    in_special_tag = False
-                else:
-                    text += c
-            else:
-                # not in tag
-                if c == "<":
-                    self.add_tag("b")
-                    self.add_text(text, force=True)
-                    self.add_tag("/b")
-                    text = c
-                    in_tag = True
-                else:
-                    text += c
+                    continue
+                if in_special_tag:
+                    self.add_tag("i")
+                self.add_text(text, force=True)
+                if in_special_tag:
+                    self.add_tag("/i")
+                text = ""
+                in_tag = False
+                in_special_tag = False
+        self.text = text
+        self.in_tag = in_tag
+        self.in_quoted_value = in_quoted_value
+        self.in_special_tag = in_special_tag
+        self.quote_terminator = quote_type
+
+    def close(self):
         self.add_tag("/pre")
         return self.finish()
 
@@ -4286,7 +5669,240 @@ INHERITED_PROPERTIES = {
 }
 
 
-def style(node, rules, depth=0):
+def style(node, rules):
+    style_tree(node, RuleIndex(rules), AncestorFilter())
+
+
+class RuleIndex:
+    # rules bucketed by the tag or class their rightmost compound selector
+    # requires, a node is only tested against rules from its own buckets
+    def __init__(self, rules):
+        self.rules = rules
+        self.by_tag = {}
+        self.by_class = {}
+        self.universal = []
+        self.candidates_by_key = {}
+        self.shareable_by_key = {}
+        self.required = [
+            AncestorFilter.required(ancestor_keys(selector)) for selector, body in rules
+        ]
+        self.has_children_test = [
+            contains_has_selector(selector) for selector, body in rules
+        ]
+        for index, (selector, body) in enumerate(rules):
+            keys = selector_keys(selector)
+            if keys is None:
+                self.universal.append(index)
+                continue
+            for kind, value in keys:
+                buckets = self.by_tag if kind == "tag" else self.by_class
+                bucket = buckets.setdefault(value, [])
+                if not bucket or bucket[-1] != index:
+                    bucket.append(index)
+
+    def candidates(self, node):
+        if isinstance(node, Element):
+            key = (node.tag, node.attributes.get("class", ""))
+        else:
+            key = None
+        candidates = self.candidates_by_key.get(key)
+        if candidates is None:
+            indices = set(self.universal)
+            if key:
+                indices.update(self.by_tag.get(key[0], ()))
+                indices.update(self.by_class.get(key[1], ()))
+            # original order is the cascade order
+            candidates = [
+                (*self.rules[i], self.required[i]) for i in sorted(indices)
+            ]
+            self.candidates_by_key[key] = candidates
+            # :has() looks at children, which differ between siblings
+            self.shareable_by_key[key] = not any(
+                self.has_children_test[i] for i in indices
+            )
+        return candidates
+
+    def sharing_key(self, node):
+        # siblings with equal keys are styled the same, None when the
+        # style has to be computed for this node alone
+        if not isinstance(node, Element):
+            return "text"
+        key = (node.tag, node.attributes.get("class", ""))
+        if key not in self.shareable_by_key:
+            self.candidates(node)
+        if not self.shareable_by_key[key]:
+            return None
+        return (node.tag, tuple(node.attributes.items()), node.isvisited)
+
+
+def selector_keys(selector):
+    # (kind, value) pairs of which a matching node has at least one,
+    # None when the selector can match any node
+    if isinstance(selector, TagSelector):
+        return [("tag", selector.tag)]
+    if isinstance(selector, ClassSelector):
+        return [("class", selector.class_name)]
+    if isinstance(selector, ImportantSelector):
+        return selector_keys(selector.child)
+    if isinstance(selector, (HasSelector, VisitedSelector)):
+        return selector_keys(selector.base)
+    if isinstance(selector, DescendantSelector):
+        return selector_keys(selector.list[-1])
+    if isinstance(selector, SequenceSelector):
+        # every part has to match, any single part narrows it down
+        keys = None
+        for item in selector.list:
+            item_keys = selector_keys(item)
+            if item_keys is not None and (keys is None or item_keys[0][0] == "class"):
+                keys = item_keys
+        return keys
+    if isinstance(selector, OrSelector):
+        keys = []
+        for item in selector.list:
+            item_keys = selector_keys(item)
+            if item_keys is None:
+                return None
+            keys.extend(item_keys)
+        return keys
+    return None
+
+
+def contains_has_selector(selector):
+    if isinstance(selector, HasSelector):
+        return True
+    if isinstance(selector, ImportantSelector):
+        return contains_has_selector(selector.child)
+    if isinstance(selector, VisitedSelector):
+        return contains_has_selector(selector.base)
+    if isinstance(selector, (DescendantSelector, SequenceSelector, OrSelector)):
+        return any(contains_has_selector(item) for item in selector.list)
+    return False
+
+
+def ancestor_keys(selector):
+    # counts of (kind, value) keys that the ancestors of a matching node
+    # must have between them, None when nothing is known
+    while isinstance(selector, (ImportantSelector, HasSelector, VisitedSelector)):
+        if isinstance(selector, ImportantSelector):
+            selector = selector.child
+        else:
+            selector = selector.base
+    if not isinstance(selector, DescendantSelector):
+        return None
+    counts = {}
+    for item in selector.list[:-1]:
+        # each part matches a different ancestor
+        for key in set(required_keys(item)):
+            counts[key] = counts.get(key, 0) + 1
+    return counts or None
+
+
+def required_keys(selector):
+    # (kind, value) keys that every node matching the selector has
+    if isinstance(selector, TagSelector):
+        return [("tag", selector.tag)]
+    if isinstance(selector, ClassSelector):
+        return [("class", selector.class_name)]
+    if isinstance(selector, ImportantSelector):
+        return required_keys(selector.child)
+    if isinstance(selector, (HasSelector, VisitedSelector)):
+        return required_keys(selector.base)
+    if isinstance(selector, SequenceSelector):
+        keys = []
+        for item in selector.list:
+            keys.extend(required_keys(item))
+        return keys
+    return []
+
+
+class AncestorFilter:
+    # counting bloom filter of the tags and classes on the ancestor chain
+    # of the node being styled, counts can only overestimate so a selector
+    # is only rejected when its required ancestors are definitely missing
+    SIZE = 1024
+
+    def __init__(self):
+        self.counts = [0] * AncestorFilter.SIZE
+
+    @staticmethod
+    def slots(key):
+        h = hash(key)
+        return h & 1023, (h >> 10) & 1023
+
+    @staticmethod
+    def required(keys):
+        if not keys:
+            return None
+        return tuple(
+            (*AncestorFilter.slots(key), count) for key, count in keys.items()
+        )
+
+    def may_match(self, required):
+        counts = self.counts
+        for first, second, count in required:
+            if counts[first] < count or counts[second] < count:
+                return False
+        return True
+
+    def push(self, node):
+        slots = AncestorFilter.slots(("tag", node.tag)) + AncestorFilter.slots(
+            ("class", node.attributes.get("class", ""))
+        )
+        counts = self.counts
+        for slot in slots:
+            counts[slot] += 1
+        return slots
+
+    def pop(self, slots):
+        counts = self.counts
+        for slot in slots:
+            counts[slot] -= 1
+
+
+def style_tree(node, index, ancestors, shared_style=None):
+    if shared_style is not None:
+        node.style = shared_style
+    else:
+        compute_style(node, index, ancestors)
+    node.style_dirty = False
+    node.font = None
+
+    if node.children:
+        node.children_dirty = False
+        slots = ancestors.push(node)
+        # siblings that are alike get the very same dict, style dicts are
+        # never modified after style() so sharing them is safe
+        shared = {}
+        for child in node.children:
+            key = index.sharing_key(child)
+            style_tree(child, index, ancestors, shared.get(key))
+            if key is not None and key not in shared:
+                shared[key] = child.style
+        ancestors.pop(slots)
+
+
+def restyle(node, index, ancestors, restyled=None):
+    # style only the subtrees marked by mark_style_dirty, the roots of
+    # those subtrees are collected into restyled for relayout
+    if node.style_dirty:
+        display = node.style.get("display")
+        style_tree(node, index, ancestors)
+        if restyled is not None:
+            # a parent groups its children by display, it has to be redone
+            if node.parent and node.style.get("display") != display:
+                restyled.append(node.parent)
+            else:
+                restyled.append(node)
+        return
+    node.children_dirty = False
+    slots = ancestors.push(node)
+    for child in node.children:
+        if child.style_dirty or child.children_dirty:
+            restyle(child, index, ancestors, restyled)
+    ancestors.pop(slots)
+
+
+def compute_style(node, index, ancestors):
     node.style = {}
 
     for property, default_value in INHERITED_PROPERTIES.items():
@@ -4295,7 +5911,9 @@ def style(node, rules, depth=0):
         else:
             node.style[property] = default_value
 
-    for selector, body in rules:
+    for selector, body, required in index.candidates(node):
+        if required and not ancestors.may_match(required):
+            continue
         if not selector.matches(node):
             continue
         for property, value in body.items():
@@ -4316,9 +5934,6 @@ def style(node, rules, depth=0):
         parent_px = parse_size(parent_font_size[:-2])
         node.style["font-size"] = str(node_pct * parent_px) + "px"
 
-    for child in node.children:
-        style(child, rules, depth=depth + 1)
-
 
 def cascade_priority(rule):
     selector, body = rule
@@ -4487,6 +6102,7 @@ def test():
     test_URL()
     test_CSS_parse()
     test_HTML_parse_tree()
+    test_HTML_parse_feed()
     test_HTML_parse_and_get_text()
     test_CSS_selectors()
     test_BrowserState()
@@ -4494,6 +6110,18 @@ def test():
     test_CookieJar()
     test_parse_http_date()
     test_is_simple_request()
+    test_HttpCache()
+    test_parse_cache_policy()
+    test_ConnectionPool()
+    test_request_socket_release()
+    test_read_framed_body()
+    test_CachedFont()
+    test_headless_layout()
+    test_DisplayList()
+    test_CanvasLayer()
+    test_frame_scheduling()
+    test_relayout()
+    test_JSContext()
 
 
 def test_CSS_selectors():
@@ -4527,6 +6155,54 @@ def test_CSS_selectors():
         matchcount("a:visited", '<a href="file:///t">x</a>', visited=["file:///t"]) == 1
     )
 
+    def stylecount(selector, html):
+        nodes = HTMLParser(html).parse()
+        style(nodes, CSSParser(selector + "{ color: red }").parse())
+        elements = [n for n in tree_to_list(nodes, []) if isinstance(n, Element)]
+        return sum(1 for n in elements if n.style["color"] == "red")
+
+    # style() rejects descendant selectors through the ancestor filter
+    assert stylecount("a b", "<a><b></b></a><b></b>") == 1
+    assert stylecount("a a b", "<a><b></b><a><b></b></a></a>") == 1
+    assert stylecount(".x b", '<i class="x"><b></b></i><i><b></b></i>') == 1
+    assert stylecount("i.x b", '<i class="x"><b></b></i><p class="x"><b></b></p>') == 1
+    assert stylecount("a b, i", "<a><b></b></a><b></b><i></i>") == 2
+    assert stylecount("a b { color: red !important } i", "<a><b></b></a><b></b><i></i>") == 2
+    assert stylecount(" ".join(["i"] * 4), "<i>" * 3 + "</i>" * 3) == 0
+    assert stylecount(" ".join(["i"] * 4), "<i>" * 5 + "</i>" * 5) == 2
+
+    # alike siblings share one style dict
+    nodes = HTMLParser("<ul><li>a</li><li>b<i>i</i>c</li><li class=x>c</li></ul>").parse()
+    style(nodes, CSSParser(".x { color: red }").parse())
+    a, b, c = nodes.children[0].children[0].children
+    assert a.style is b.style and a.style is not c.style
+    assert b.children[0].style is b.children[2].style
+    assert c.style["color"] == "red" and a.style["color"] == "black"
+    nodes = HTMLParser("<ul><li>a</li><li><b>b</b></li></ul>").parse()
+    style(nodes, CSSParser("li:has(b) { color: red }").parse())
+    a, b = nodes.children[0].children[0].children
+    assert a.style["color"] == "black" and b.style["color"] == "red"
+
+    # restyle only touches the subtrees marked dirty
+    rules = CSSParser(".x b { color: red } i { color: blue }").parse()
+    nodes = HTMLParser("<p><b>1</b></p><p class=x><b>2</b></p>").parse()
+    style(nodes, rules)
+    first, second = nodes.children[0].children
+    untouched = first.children[0].style
+    second.children[0].append_child(Element("b", {}, None))
+    second.attributes["class"] = "y"
+    mark_style_dirty(second)
+    restyle(nodes, RuleIndex(rules), AncestorFilter())
+    assert first.children[0].style is untouched
+    assert second.children[0].style["color"] == "black"
+    assert second.children[0].children[-1].style["color"] == "black"
+    first.append_child(Element("i", {}, None))
+    assert first.style_dirty and nodes.children[0].children_dirty
+    assert nodes.children_dirty and not nodes.style_dirty
+    restyle(nodes, RuleIndex(rules), AncestorFilter())
+    assert first.children[-1].style["color"] == "blue"
+    assert not nodes.children_dirty and not first.style_dirty
+
 
 def test_CSS_parse():
     def parse(str):
@@ -4652,6 +6328,49 @@ def test_HTML_parse_tree():
     dom = f('<div style="display: none;"></div>')
     assert dom.body.children[0].attributes["style"] == "display: none;"
 
+    dom = f("<a title='one two' HREF=/x disabled>link</a>")
+    assert dom.body.children[0].attributes == {"title": "one two", "href": "/x", "disabled": ""}
+
+    # unknown entities run until ; and are kept as written
+    dom = f("<p>AT&T <i>x</i>; ok &lt;</p>")
+    assert dom.get_text() == "AT&T <i>x</i>; ok <"
+
+    dom = f("<p>a<!-- <b>b</b> --->c<!DOCTYPE x>d</p>")
+    assert dom.get_text() == "acd"
+
+    # names and indentation are shared between nodes
+    first, second = f("<DIV Class=a>\n  </DIV><div class=b>\n  </div>").body.children
+    assert first.tag is second.tag
+    assert list(first.attributes)[0] is list(second.attributes)[0]
+    assert first.children[0].text is second.children[0].text
+
+
+def test_HTML_parse_feed():
+    html = (
+        "<title>t&amp;c</title><!-- a -- b --><p class='x y'>one &lt; two"
+        "<script>if (a<b) x = '</p>'</script><ul><li>1<li>2</ul><b>bo<i>ld</b>"
+    )
+    whole = format_tree_HTML(HTMLParser(html).parse())
+    for size in [1, 3, 7]:
+        parser = HTMLParser()
+        for i in range(0, len(html), size):
+            parser.feed(html[i:i + size])
+        assert format_tree_HTML(parser.close()) == whole
+    source = format_tree_HTML(HTMLSourceParser(html).parse())
+    parser = HTMLSourceParser()
+    for c in html:
+        parser.feed(c)
+    assert format_tree_HTML(parser.close()) == source
+
+    # open elements are reachable from the root before parsing finishes
+    parser = HTMLParser()
+    parser.feed("<div><p>first</p><p>sec")
+    root = parser.tree()
+    assert root.get_text() == "first"
+    parser.feed("ond</p></div>")
+    assert parser.close() is root
+    assert root.get_text() == "firstsecond"
+
 
 def test_HTML_parse_and_get_text():
     def f(x):
@@ -4931,6 +6650,440 @@ def test_parse_http_date():
     assert fmt(1730220992) == "Tue, 29 Oct 2024 16:56:32 GMT"
 
 
+def test_parse_cache_policy():
+    def f(headers):
+        return parse_cache_policy(headers, now=1000)
+
+    assert f({}) == {"expires": 0}
+    assert f({"cache-control": "max-age=60"}) == {"expires": 1060}
+    assert f({"cache-control": "public, max-age=60"}) == {"expires": 1060}
+    assert f({"cache-control": "no-store"}) is None
+    assert f({"cache-control": "no-store, max-age=60"}) is None
+    assert f({"cache-control": "private"}) is None
+    assert f({"cache-control": "no-cache"}) is None
+    assert f({"cache-control": "max-age=0"}) is None
+    assert f({"cache-control": "no-cache", "etag": '"x"'}) == {
+        "expires": 0,
+        "etag": '"x"',
+        "revalidate": True,
+    }
+    assert f({"cache-control": "max-age=0, must-revalidate", "etag": "1"})["revalidate"]
+    assert f({"etag": "1"})["revalidate"]
+    assert f({"last-modified": format_http_date(0)})["revalidate"]
+    assert f({"expires": format_http_date(1100)}) == {"expires": 1100}
+    assert f({"expires": "0"}) is None
+    assert f({"expires": "0", "etag": "1"})["revalidate"]
+    assert f({"cache-control": "max-age=10", "expires": "0"}) == {"expires": 1010}
+
+
+def test_CachedFont():
+    class Font:
+        calls = 0
+
+        def measure(self, text):
+            Font.calls += 1
+            return len(text) * 7
+
+        def metrics(self):
+            Font.calls += 1
+            return {"ascent": 10, "descent": 3, "linespace": 13, "fixed": 0}
+
+    font = CachedFont(Font())
+    assert font.space_width == 7 and font.measure(" ") == 7
+    assert font.measure("the") == 21 and font.measure("the") == 21
+    assert Font.calls == 2
+    assert font.metrics("ascent") == 10 and font.metrics("linespace") == 13
+    assert font.metrics()["descent"] == 3
+    assert Font.calls == 3
+
+    # least recently used widths are dropped first
+    for i in range(CachedFont.MAX_WIDTHS):
+        font.measure(str(i))
+        font.measure("the")
+    assert "the" in font.widths and "0" not in font.widths
+    assert len(font.widths) == CachedFont.MAX_WIDTHS
+
+
+def test_headless_layout():
+    global font_backend
+
+    backend = font_backend
+    font_backend = "headless"
+    try:
+        font = get_font("", 12, "normal", "roman")
+        assert font.measure("ii") == 7 and font.measure("mm") == 27
+        assert get_font("", 12, "bold", "roman").measure("mm") == 29
+        assert get_font("monospace", 12, "normal", "roman").measure("ii") == 19
+        assert font.metrics("linespace") == 18
+
+        cli = CLI(output="layout")
+        cli.width = 200
+        html = "<p>one two three four five six seven eight</p><input value=x>"
+        document = cli.layout(HTMLParser(html).parse(), URL("about:blank"))
+        texts = [x for x in tree_to_list(document, []) if isinstance(x, TextLayout)]
+        assert [t.word for t in texts[:2]] == ["one", "two"]
+        assert texts[0].x == 12 and texts[1].x == texts[0].x + texts[0].width + 4
+        lines = sorted(set(t.y for t in texts))
+        assert len(lines) > 1
+        inputs = [x for x in tree_to_list(document, []) if isinstance(x, InputLayout)]
+        assert inputs[0].width == 200
+        again = cli.layout(HTMLParser(html).parse(), URL("about:blank"))
+        assert repr(tree_to_list(document, [])) == repr(tree_to_list(again, []))
+    finally:
+        font_backend = backend
+
+
+def test_DisplayList():
+    import random
+
+    random.seed(7)
+    cmds = []
+    for i in range(500):
+        top = random.uniform(-100, 5000)
+        height = random.choice([0, 10, 300, 3000])
+        rect = Rect(random.uniform(0, 700), top, random.uniform(0, 800), top + height)
+        if i % 5 == 0:
+            cmds.append(DrawLine(rect.left, rect.top, rect.right, rect.bottom, "red", 1))
+        else:
+            cmds.append(DrawRect(rect, "red", i))
+    display_list = DisplayList(cmds)
+    assert len(display_list) == 500 and list(display_list) == cmds
+    for index, cmd in enumerate(cmds):
+        first, last = display_list.band_range(cmd.rect.top, cmd.rect.bottom)
+        found = [band for band, indices in display_list.bands.items() if index in indices]
+        assert sorted(found) == list(range(first, last + 1))
+    for i in range(300):
+        x, y = random.uniform(0, 800), random.uniform(-100, 6000)
+        expected = None
+        for cmd in reversed(cmds):
+            if cmd.rect.contains_point(x, y) and hasattr(cmd, "node"):
+                expected = cmd
+                break
+        assert display_list.hit_test(x, y) is expected
+    assert DisplayList().bands == {} and DisplayList().hit_test(0, 0) is None
+
+
+def test_CanvasLayer():
+    class Canvas:
+        # keeps items in stacking order, bottom first
+        def __init__(self):
+            self.stack = []
+            self.y = {}
+            self.created = 0
+
+        def create_rectangle(self, left, top, right, bottom, tags=(), **kw):
+            self.created += 1
+            item = (self.created, tags)
+            self.stack.append(item)
+            self.y[item] = top
+            return item
+
+        def delete(self, tag):
+            self.stack = [item for item in self.stack if item[1] != tag]
+
+        def move(self, tag, dx, dy):
+            for item in self.stack:
+                if item[1] == tag:
+                    self.y[item] += dy
+
+        def tag_lower(self, tag, below=None):
+            moved = [item for item in self.stack if item == tag or item[1] == tag]
+            rest = [item for item in self.stack if item not in moved]
+            at = rest.index(below) if below else 0
+            self.stack = rest[:at] + moved + rest[at:]
+
+    # one tall background painted first and boxes every 100px on top of it
+    cmds = [DrawRect(Rect(0, 300, 100, 2000), "grey", None)]
+    cmds += [DrawRect(Rect(0, y, 100, y + 50), "red", None) for y in range(0, 2000, 100)]
+    display_list = DisplayList(cmds)
+    canvas = Canvas()
+    canvas.create_rectangle(0, 0, 100, 10, tags="chrome")
+    layer = CanvasLayer("content")
+    layer.draw(canvas, display_list, 0, 10, 200)
+    assert canvas.created == 1 + 3  # chrome and the boxes at 0, 100 and 200
+    assert canvas.stack[-1][1] == "chrome"
+
+    # scrolling moves what is there and only creates the newly visible bands
+    layer.draw(canvas, display_list, 300, 10, 200)
+    box = layer.items[layer.indices.index(2)]
+    assert canvas.y[box] == 100 + 10 - 300
+    assert canvas.created == 1 + 3 + 4
+    content = [item for item in canvas.stack if item[1] == "content"]
+    # the tall background came up late but still sits under the boxes
+    assert [layer.indices[layer.items.index(item)] for item in content] == sorted(layer.indices)
+    assert canvas.stack[-1][1] == "chrome"
+    layer.draw(canvas, display_list, 0, 10, 200)
+    assert canvas.created == 1 + 3 + 4
+
+    # a new display list starts over
+    layer.draw(canvas, DisplayList(cmds[:2]), 0, 10, 200)
+    assert len([item for item in canvas.stack if item[1] == "content"]) == 1
+
+
+def test_frame_scheduling():
+    class Window:
+        def __init__(self):
+            self.idle = []
+
+        def after_idle(self, callback):
+            self.idle.append(callback)
+
+    browser = GUIBrowser()
+    browser.window = Window()
+    browser.state = None
+    tab = GUIBrowserTab(browser)
+    tab.nodes = HTMLParser("<p>a</p>").parse()
+    tab.rules = CSSParser("i { color: red }").parse()
+
+    # any number of requests before tk is idle make a single frame
+    browser.draw()
+    tab.schedule_render()
+    tab.schedule_render()
+    assert browser.window.idle == [browser.draw_frame]
+    browser.frame_pending = False
+    browser.window.idle.clear()
+
+    # styles can be brought up to date without waiting for the frame
+    tab.update_style()
+    p = tab.nodes.children[0].children[0]
+    p.append_child(Element("i", {}, None))
+    tab.schedule_render()
+    tab.update_style()
+    assert p.children[-1].style["color"] == "red"
+    assert tab.relayout_nodes[-1] is p and len(browser.window.idle) == 1
+
+
+def test_relayout():
+    global font_backend
+
+    backend = font_backend
+    font_backend = "headless"
+    try:
+        class Browser:
+            state = None
+
+            def draw(self):
+                pass
+
+        html = "<h1>title</h1><ul><li>one<li>two</ul><p class=x>some text here</p><div><p>after</p></div>"
+        tab = GUIBrowserTab(Browser())
+        tab.width, tab.height = 300, 400
+        tab.hstep, tab.vstep = 12, 18
+        tab.nodes = HTMLParser(html).parse()
+        tab.rules = get_initial_styling_rules() + CSSParser(".hidden { display: none } .big { font-size: 30px }").parse()
+        tab.render()
+        body = tab.nodes.body
+        ul, p = body.children[1], body.children[2]
+        blocks = tab.document.blocks
+        unchanged = blocks[body.children[0]]
+
+        def check():
+            # same geometry as laying out everything from scratch
+            tab.render()
+            assert tab.document.children[0] is blocks[tab.nodes]
+            again = DocumentLayout(tab.nodes)
+            again.set_size(tab.width, tab.height)
+            again.set_step(tab.hstep, tab.vstep)
+            again.layout()
+            assert repr(tree_to_list(tab.document, [])) == repr(tree_to_list(again, []))
+            assert tab.scroll_bottom == again.height
+
+        li = Element("li", {}, None)
+        li.append_child(Text("three", None))
+        ul.append_child(li)
+        check()
+        p.attributes["class"] = "big"
+        mark_style_dirty(p)
+        check()
+        # the heading before the changes was kept as it was
+        assert blocks[body.children[0]] is unchanged
+        ul.attributes["class"] = "hidden"
+        mark_style_dirty(ul)
+        check()
+        ul.attributes["class"] = ""
+        mark_style_dirty(ul)
+        body.children[3].children[0].remove()
+        check()
+    finally:
+        font_backend = backend
+
+
+def test_read_framed_body():
+    import io
+    import gzip
+    import zlib
+
+    def read(headers, body, size=4):
+        return list(read_framed_body(200, headers, io.BytesIO(body), size))
+
+    assert read({"content-length": "10"}, b"0123456789rest") == [b"0123", b"4567", b"89"]
+    assert read({"transfer-encoding": "chunked"}, b"3\r\nabc\r\n2;ext=1\r\nde\r\n0\r\n\r\n") == [b"abc", b"de"]
+    assert read({}, b"until end") == [b"unti", b"l en", b"d"]
+    assert list(read_framed_body(304, {"content-length": "3"}, io.BytesIO(b"abc"))) == []
+    try:
+        read({"content-length": "10"}, b"short")
+        assert False
+    except ConnectionResetError:
+        pass
+
+    # characters split between chunks decode once complete
+    data = "őrült €".encode("utf8")
+    chunks = [data[i:i + 1] for i in range(len(data))]
+    assert "".join(decode_chunks(chunks)) == "őrült €"
+    assert "".join(decode_chunks([b"caf\xe9"], "iso8859-1")) == "café"
+
+    # gzip is inflated incrementally
+    packed = gzip.compress(b"hello " * 100)
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    inflated = b"".join(decompressor.decompress(c) for c in read({}, packed)) + decompressor.flush()
+    assert inflated == b"hello " * 100
+
+    assert parse_charset("") == "utf-8"
+    assert parse_charset("text/html; charset=ISO-8859-1") == "iso8859-1"
+    assert parse_charset('text/css;charset="windows-1252"') == "cp1252"
+    assert parse_charset("text/html; charset=bogus") == "utf-8"
+
+
+def test_ConnectionPool():
+    import socket
+
+    opened = []
+
+    def connect():
+        a, b = socket.socketpair()
+        opened.append(b)
+        return a, a.makefile("rb")
+
+    pool = ConnectionPool(max_per_host=2, max_total=3)
+    conn1, reused = pool.acquire("a", connect)
+    assert not reused
+    pool.release("a", conn1, keep_alive=True)
+    conn2, reused = pool.acquire("a", connect)
+    assert reused and conn2 is conn1
+    conn3, reused = pool.acquire("a", connect)
+    assert not reused and pool.in_use["a"] == 2
+
+    # peer closed an idle connection, it is not handed out again
+    pool.release("a", conn2, keep_alive=True)
+    pool.release("a", conn3, keep_alive=True)
+    opened[1].close()
+    conn4, reused = pool.acquire("a", connect)
+    assert reused and conn4 is conn1
+    assert pool.open_count == 1
+
+    # global cap closes the oldest idle connection of another host
+    conn5, _ = pool.acquire("b", connect)
+    conn6, _ = pool.acquire("b", connect)
+    pool.release("b", conn5, keep_alive=True)
+    pool.release("b", conn6, keep_alive=False)
+    assert pool.open_count == 2
+    conn7, reused = pool.acquire("c", connect)
+    conn8, reused = pool.acquire("c", connect)
+    assert not reused and pool.open_count == 3
+    assert pool.idle["b"] == []
+
+    for conn in [conn4, conn7, conn8]:
+        pool.release("a" if conn is conn4 else "c", conn, keep_alive=False)
+    assert pool.open_count == 0
+    for s in opened:
+        s.close()
+
+
+def test_request_socket_release():
+    import io
+    import socket
+    import contextlib
+
+    peers = []
+
+    def serve(url, response):
+        def connect():
+            a, b = socket.socketpair()
+            b.sendall(response)
+            peers.append(b)
+            return a, a.makefile("rb")
+        url.connect = connect
+
+    pool = get_connection_pool()
+    url = URL("http://release.test/")
+    key = (url.scheme, url.host, url.port)
+    # status lines are logged for every response
+    quiet = contextlib.redirect_stdout(io.StringIO())
+
+    # a status line that does not decode still gives the connection back
+    serve(url, b"HTTP/1.1 200 \xff\xfe\r\n\r\n")
+    try:
+        with quiet:
+            url.request_socket(readcache=False)
+        assert False
+    except UnicodeDecodeError:
+        pass
+    assert pool.in_use[key] == 0
+
+    # a body that is closed unread releases the connection without reuse
+    ok = b"HTTP/1.1 200 OK\r\nContent-Length: 5\r\nConnection: keep-alive\r\n"
+    serve(url, ok + b"\r\nhello")
+    with quiet:
+        headers, body, _ = url.request_socket(readcache=False)
+    assert pool.in_use[key] == 1
+    body.close()
+    assert pool.in_use[key] == 0 and not pool.idle.get(key)
+
+    # errors while handling the response release it too
+    class BrokenJar:
+        def get_cookie_items_by_host(self, host):
+            return []
+
+        def set_cookie_by_host(self, host, cookie):
+            raise ValueError("bad cookie")
+
+    serve(url, ok + b"Set-Cookie: a=b\r\n\r\nhello")
+    try:
+        with quiet:
+            url.request_socket(readcache=False, cookies=BrokenJar())
+        assert False
+    except ValueError:
+        pass
+    assert pool.in_use[key] == 0
+
+    # a body read to the end keeps the connection alive
+    serve(url, ok + b"\r\nhello")
+    with quiet:
+        headers, body, _ = url.request_socket(readcache=False)
+    assert "".join(body) == "hello"
+    assert pool.in_use[key] == 0 and len(pool.idle[key]) == 1
+
+    # a stale reused connection is retried once, not once per idle connection
+    pool.close_all()
+    for i in range(3):
+        a, b = socket.socketpair()
+        peers.append(b)
+        pool.idle.setdefault(key, []).append(((a, io.BytesIO()), 0))
+        pool.open_count += 1
+    pool.idle_timeout = float("inf")
+    try:
+        with quiet:
+            url.request_socket(readcache=False)
+        assert False
+    except ConnectionResetError:
+        pass
+    pool.idle_timeout = 60
+    assert pool.in_use[key] == 0 and len(pool.idle[key]) == 1
+
+    # with every slot taken acquire gives up instead of waiting forever
+    busy = ConnectionPool(max_per_host=1, acquire_timeout=0.01)
+    busy.acquire("a", lambda: (None, None))
+    try:
+        busy.acquire("a", lambda: (None, None))
+        assert False
+    except TimeoutError:
+        pass
+
+    pool.close_all()
+    for s in peers:
+        s.close()
+
+
 def test_is_simple_request():
     chk = is_simple_request
     assert chk("GET") is True
@@ -4949,6 +7102,227 @@ def test_is_simple_request():
     assert chk("GET", {"Range": "bytes=127-255"}) is True
 
 
+def test_JSContext():
+    import gc
+    import io
+    import contextlib
+
+    try:
+        import dukpy
+    except ImportError:
+        return  # scripting is optional
+
+    class Browser:
+        state = None
+
+        def draw(self):
+            pass
+
+    tab = GUIBrowserTab(Browser())
+    tab.nodes = HTMLParser("<div class=box><i>first</i></div>").parse()
+    js = JSContext(tab)
+    box = tab.nodes.body.children[0]
+    run = lambda code: js.run("test", code)
+    run("box = document.querySelectorAll('.box')[0]")
+
+    # mutations are queued and applied in order, reads see them right away
+    result = run("""
+        var a = document.createElement('b');
+        a.setAttribute('title', 'x');
+        box.appendChild(a);
+        var b = document.createElement('u');
+        box.insertBefore(b, a);
+        b.appendChild(document.createTextNode('text'));
+        a.getAttribute('title') + box.children.length
+    """)
+    assert result == "x3"
+    assert [child.tag for child in box.children] == ["i", "u", "b"]
+    assert box.children[1].children[0].text == "text"
+
+    # one failing command does not drop the ones queued after it
+    handle = js.node_to_handle[box.children[2]]
+    with contextlib.redirect_stdout(io.StringIO()) as out:
+        js._batch(["removeChild", handle, 10 ** 6, None, "setAttribute", handle, "title", "y"])
+    assert "removeChild failed" in out.getvalue()
+    assert box.children[2].attributes["title"] == "y"
+
+    # ids from innerHTML are globals as soon as the setter returns
+    assert run("box.innerHTML = '<p id=zz>hi</p>'; typeof zz") == "object"
+    assert run("box.innerHTML = 'just text'; typeof zz") == "undefined"
+
+    # events nobody listens for never enter the interpreter
+    run("box.innerHTML = '<i>in</i>'; inner = box.children[0]")
+    run("box.addEventListener('keydown', function(e) { seen = e.type; e.preventDefault() })")
+    inner = box.children[0]
+    calls = []
+    interp_evaljs = js.interp.evaljs
+    js.interp.evaljs = lambda code, **kw: calls.append(code) or interp_evaljs(code, **kw)
+    assert js.dispatch_event("click", inner) is False and calls == []
+    assert js.dispatch_event("click", box) is False and calls == []
+    # listeners on ancestors are still reached through bubbling
+    assert js.dispatch_event("keydown", inner) is True and len(calls) == 1
+    assert run("seen") == "keydown"
+    js.interp.evaljs = interp_evaljs
+
+    # nodes js dropped are unpinned and collected once the page drops them
+    gc.collect()
+    pinned, refs = set(js.pinned), len(js.handle_to_ref)
+    run("""(function() {
+        var div = document.createElement('div');
+        div.appendChild(document.createTextNode('gone'));
+        box.appendChild(div);
+        box.removeChild(div);
+    })()""")
+    assert set(js.pinned) == pinned and len(js.handle_to_ref) == refs + 2
+    gc.collect()
+    run("0")
+    assert len(js.handle_to_ref) == refs and not js.dead_handles
+
+    # listeners outlive the wrapper they were added through
+    run("""inner = undefined; (function() {
+        box.children[0].addEventListener('click', function() { clicked = true });
+    })()""")
+    handle = js.node_to_handle[inner]
+    assert handle not in js.pinned
+    assert js.dispatch_event("click", inner) is False and run("clicked") is True
+
+    # a release queued before the handle was given out again is ignored
+    assert handle not in js.pinned
+    js.add_global_name("again", inner)
+    js._batch(["release", handle, js.wrapped[handle] - 1, None])
+    assert js.pinned[handle] is inner
+    run("again = undefined")
+    assert handle not in js.pinned
+
+
+def test_HttpCache():
+    import os
+    import tempfile
+
+    def crash(cache):
+        # drop the process state without compacting
+        cache.journal_records = 0
+        cache.close()
+
+    with tempfile.TemporaryDirectory() as dir:
+        cache = HttpCache(dir)
+        cache.put("a", {"expires": 0}, b"first")
+        cache.put("b", {"expires": 0}, b"second")
+        cache.remove("a")
+
+        # records survive without compaction, replayed from the journal
+        crash(cache)
+        restored = HttpCache(dir)
+        assert restored.get("a") is None
+        assert restored.read_content(restored.get("b")) == "second"
+
+        restored.close()
+
+        # torn last record is ignored and later records still replay
+        with open(restored.journal_path, "a", encoding="utf8") as f:
+            f.write('{"key": "c", "ent')
+        restored = HttpCache(dir)
+        assert restored.get("c") is None
+        restored.put("d", {"expires": 0}, b"fourth")
+        crash(restored)
+        restored = HttpCache(dir)
+        assert restored.read_content(restored.get("d")) == "fourth"
+
+        restored.close()
+        assert not os.path.isfile(restored.journal_path)
+        restored = HttpCache(dir)
+        restored.load()
+        assert list(restored.entries.keys()) == ["b", "d"]
+        restored.close()
+
+        # blobs not referenced by the index are swept on load
+        with open(restored.blob_dir + "/orphan", "wb") as f:
+            f.write(b"orphan")
+        restored = HttpCache(dir)
+        restored.load()
+        assert not os.path.isfile(restored.blob_dir + "/orphan")
+        assert len(os.listdir(restored.blob_dir)) == 2
+        restored.close()
+
+        # least recently used entries are evicted to stay within budget
+        cache = HttpCache(dir, disk_budget=15)
+        assert cache.get("b")
+        cache.put("e", {"expires": 0}, b"fifth")
+        assert cache.get("d") is None
+        assert cache.get("b") and cache.get("e")
+        assert len(os.listdir(cache.blob_dir)) == 2
+        cache.close()
+
+        # identical bodies share one blob until the last reference goes
+        cache = HttpCache(dir)
+        cache.put("x1", {"expires": 0}, b"same")
+        cache.put("x2", {"expires": 0}, b"same")
+        blob_id = cache.get("x1")["blob_id"]
+        assert cache.get("x2")["blob_id"] == blob_id
+        assert cache.blob_refs[blob_id] == [2, 4]
+        cache.remove("x1")
+        assert os.path.isfile(cache.blob_dir + "/" + blob_id)
+        assert cache.read_content(cache.get("x2")) == "same"
+        cache.remove("x2")
+        assert not os.path.isfile(cache.blob_dir + "/" + blob_id)
+        cache.close()
+
+        # an overgrown journal is compacted off the calling thread
+        cache = HttpCache(dir)
+        cache.load()
+        for i in range(HttpCache.JOURNAL_SLACK + 10):
+            cache.update("b", cache.get("b"))
+        cache.compaction.result()
+        assert cache.journal_records < HttpCache.JOURNAL_SLACK
+        assert not os.path.isfile(cache.old_journal_path)
+        keys = list(cache.entries.keys())
+        crash(cache)
+        restored = HttpCache(dir)
+        restored.load()
+        assert list(restored.entries.keys()) == keys
+
+        # a compaction that fails does not keep later ones from running
+        restored.entries["bad"] = {"expires": {0}}
+        try:
+            restored.compact()
+            assert False, "unserializable entry written"
+        except TypeError:
+            pass
+        assert not restored.compacting
+        del restored.entries["bad"]
+        restored.compact()
+        assert restored.journal_records == 0
+        restored.close()
+
+        # streamed bodies are stored once complete, abandoned ones leave nothing
+        cache = HttpCache(dir)
+        chunks = cache.write_stream("s", {"expires": 0, "charset": "cp1252"}, iter([b"caf", b"\xe9"]))
+        assert b"".join(chunks) == b"caf\xe9"
+        assert cache.read_content(cache.get("s")) == "caf\u00e9"
+        chunks = cache.write_stream("t", {"expires": 0}, iter([b"part", b"ial"]))
+        next(chunks)
+        chunks.close()
+        assert cache.get("t") is None
+        assert not [name for name in os.listdir(cache.blob_dir) if name.endswith(".tmp")]
+        cache.close()
+
+    cache = HttpCache(None)
+    cache.put("a", {"expires": 0}, b"mem")
+    cache.put("b", {"expires": 0}, b"mem")
+    assert cache.read_content(cache.get("a")) == "mem"
+    assert cache.size == 3 and len(cache.blobs) == 1
+
+    cache = HttpCache(None, memory_budget=10)
+    cache.put("a", {"expires": 0}, b"aaaa")
+    cache.put("b", {"expires": 0}, b"bbbb")
+    cache.get("a")
+    cache.put("c", {"expires": 0}, b"cccc")
+    assert list(cache.entries.keys()) == ["a", "c"]
+    assert cache.size == 8
+    cache.put("d", {"expires": 0}, b"x" * 11)
+    assert cache.get("d") is None
+
+
 def integration_test(browser, testsuite):
     import os
     import time
@@ -4975,11 +7349,10 @@ def integration_test(browser, testsuite):
             browsepath = itempath
 
             if item.endswith(".py"):
-                global http_cache
                 import subprocess
                 import sys
 
-                http_cache = {}  # wipe http cache
+                get_http_cache().clear()  # wipe http cache
 
                 if not portstr:
                     portstr = "9099"
@@ -5060,6 +7433,12 @@ if __name__ == "__main__":
                 ui = GUIBrowser()
             elif "--cli" == flag:
                 ui = CLI()
+            elif "--layout" == flag or "--display-list" == flag:
+                # dumps are laid out with the headless fonts, no display needed
+                ui = CLI(output=flag[2:])
+                font_backend = "headless"
+            elif "--headless" == flag:
+                font_backend = "headless"
             elif "--test" == flag:
                 test()
             elif "--wtest" == flag:
@@ -5083,6 +7462,11 @@ if __name__ == "__main__":
         else:
             urls.append(arg)
 
+    if isinstance(ui, CLI):
+        for url in urls:
+            ui.browse(url)
+        sys.exit(0)
+
     try:
         data.restore()
         for url in urls:
@@ -2,7 +2,26 @@
     var window = new Function('return this;')();
     /** @type {Record<number,Record<string,function[]>>} */
     var LISTENERS = {};
-    var py = call_python;
+    // mutations are queued and sent to python as one batch, anything that
+    // reads from python flushes the queue first so it sees its own writes
+    var QUEUE = [];
+    var HANDLES = { next: 0, end: 0 };
+    // flat list of [name, a, b, c] commands, marshals much faster than nested arrays
+    function queue(name, a, b, c) { QUEUE.push(name, a, b, c); }
+    function flush() { if (QUEUE.length) { var batch = QUEUE; QUEUE = []; call_python("batch", batch); } }
+    function py() { flush(); return call_python.apply(null, arguments); }
+    // tags of the nodes created here, inserting any other node may run a script
+    // or load a stylesheet and that has to happen before the caller goes on
+    var TAGS = {};
+    var LOADING_TAGS = { script: true, link: true, style: true, title: true };
+    function inserted(node) { var tag = TAGS[node.handle]; if (tag === undefined || LOADING_TAGS[tag]) flush(); }
+    function reserve() {
+        if (HANDLES.next >= HANDLES.end) {
+            HANDLES.next = call_python("reserve_handles", 256);
+            HANDLES.end = HANDLES.next + 256;
+        }
+        return HANDLES.next++;
+    }
     
     Object.defineProperties(window, {
         'location': { set: function(value) { py("location_set", value); } }
@@ -16,16 +35,23 @@
     Event.prototype.AT_TARGET = 2;
     Event.prototype.BUBBLING_PHASE = 3;
 
-    function Node(handle) { this.handle = handle; }
+    // count wrappers per handle so python can unpin a node once none are left,
+    // the release carries how many were ever made so python can tell it is stale
+    var REFS = {};
+    var WRAPPED = {};
+    function release(handle) { if (--REFS[handle] === 0) { delete REFS[handle]; queue("release", handle, WRAPPED[handle]); } }
+    var FINALIZER = typeof FinalizationRegistry !== 'undefined' ? new FinalizationRegistry(release) : null;
+    function Node(handle) { this.handle = handle; REFS[handle] = (REFS[handle] || 0) + 1; WRAPPED[handle] = (WRAPPED[handle] || 0) + 1; if (FINALIZER) FINALIZER.register(this, handle); }
+    if (!FINALIZER && typeof Duktape !== 'undefined') Duktape.fin(Node.prototype, function(node) { if (node.hasOwnProperty('handle')) release(node.handle); });
     Node.prototype.getAttribute = function(name) { return py("getAttribute", this.handle, name) }
-    Node.prototype.setAttribute = function(name, value) { py("setAttribute", this.handle, name, value); }
-    Node.prototype.appendChild = function(child) { py("appendChild", this.handle, child.handle) }
-    Node.prototype.insertBefore = function(toinsert, reference) { py("insertBefore", this.handle, toinsert.handle, reference.handle) }
-    Node.prototype.removeChild = function(toremove) { py("removeChild", this.handle, toremove.handle); return toremove; }
+    Node.prototype.setAttribute = function(name, value) { queue("setAttribute", this.handle, name, String(value)); }
+    Node.prototype.appendChild = function(child) { queue("appendChild", this.handle, child.handle); inserted(child); return child; }
+    Node.prototype.insertBefore = function(toinsert, reference) { queue("insertBefore", this.handle, toinsert.handle, reference.handle); inserted(toinsert); return toinsert; }
+    Node.prototype.removeChild = function(toremove) { queue("removeChild", this.handle, toremove.handle); return toremove; }
     Node.prototype.addEventListener = function(type, listener) { 
         if (!LISTENERS[this.handle]) LISTENERS[this.handle] = {};
         var dict = LISTENERS[this.handle];
-        if (!dict[type]) dict[type] = [];
+        if (!dict[type]) { dict[type] = []; queue("addEventListener", this.handle, type); }
         var list = dict[type];
         list.push(listener);
     }
@@ -69,9 +95,9 @@
     })
 
     function Document() {}
-    Document.prototype.querySelectorAll = function(s){ return call_python("querySelectorAll", s).map(tonode) }
-    Document.prototype.createElement = function(s){ return tonode(call_python("createElement", s)) }
-    Document.prototype.createTextNode = function(s){ return tonode(call_python("createTextNode", s)) }
+    Document.prototype.querySelectorAll = function(s){ return py("querySelectorAll", s).map(tonode) }
+    Document.prototype.createElement = function(s){ var handle = reserve(); queue("createElement", handle, s); TAGS[handle] = s; return new Node(handle) }
+    Document.prototype.createTextNode = function(s){ var handle = reserve(); queue("createTextNode", handle, s.toString()); TAGS[handle] = "#text"; return new Node(handle) }
     Object.defineProperties(Document.prototype, {
         'title': {  get: function() { return py("document_get_title")}, set: function(s) { return py("document_set_title", s.toString()); }  },
         'body': {  get: function() { return tonode(py("document_get_body")) }  },
@@ -95,7 +121,8 @@
     window.document = new Document();
     window.window = window;
     window.getComputedStyle = function(node) { return py("getComputedStyle", node.handle) }
-    __dispatch_event = function (handle, type) { var event=new Event(type); event.isTrusted=true; event.bubbles=true; event.__ret=true; return new Node(handle).dispatchEvent(event) !== false }
-    __global_node = function (name, handle) { if (typeof window[name] === 'undefined') window[name] = new Node(handle); }
+    __dispatch_event = function (handle, type) { var event=new Event(type); event.isTrusted=true; event.bubbles=true; event.__ret=true; try { return new Node(handle).dispatchEvent(event) !== false } finally { flush() } }
+    __flush = function (dead) { for (var i=0; i<dead.length; i+=1) { delete LISTENERS[dead[i]]; delete TAGS[dead[i]]; delete WRAPPED[dead[i]]; } flush(); }
+    __global_node = function (name, handle) { var node = new Node(handle); if (typeof window[name] === 'undefined') window[name] = node; }
     __global_node_remove = function (name, handle) { if (typeof window[name] !== 'undefined' && window[name] instanceof Node && window[name].handle === handle) delete window[name]; }
 })();
\ No newline at end of file